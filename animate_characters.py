@@ -1,13 +1,20 @@
 #! /usr/bin/env python3
-"""ladders_animated_moving_platforms.py - Add moving platforms and ladders."""
+"""animate_characters.py - Animate the player character."""
 
-import collections
+import contextlib
 import os
-import time
+import struct
+import sys
 
 import arcade
+import pyglet
 from arcade import key
 
+from diagnostics import FPSCounter, FrameProfiler, InputRecording
+from map_cache import HIT_BOXES, load_map
+from physics import PhysicsEngine
+from scene_layers import CoinGrid, PlatformMover, SceneChunks, TileAnimator, TileStreamer
+
 # Constraints
 SCREEN_WIDTH = 1000
 SCREEN_HEIGHT = 650
@@ -32,6 +39,24 @@ PLAYER_START_Y = SPRITE_PIXEL_SIZE * TILE_SCALING
 RIGHT_FACING = 0
 LEFT_FACING = 1
 
+# Player animation states
+IDLE, WALK, JUMP, CLIMB = range(4)
+
+# (on a ladder, moving up or down, moving sideways) -> (state, frames advance)
+PLAYER_STATES = {
+    (True, True, True): (CLIMB, True),
+    (True, True, False): (CLIMB, True),
+    (True, False, True): (CLIMB, False),
+    (True, False, False): (CLIMB, False),
+    (False, True, True): (JUMP, False),
+    (False, True, False): (JUMP, False),
+    (False, False, True): (WALK, True),
+    (False, False, False): (IDLE, False),
+}
+
+# Seconds each frame of a state's animation is shown
+PLAYER_FRAME_TIMES = {IDLE: 1, WALK: 1 / 60, JUMP: 1, CLIMB: 4 / 60}
+
 # Layer names from our TileMap
 LAYER_NAME_MOVING_PLATFORMS = "Moving Platforms"
 LAYER_NAME_PLATFORMS = "Platforms"
@@ -42,6 +67,68 @@ LAYER_NAME_DONT_TOUCH = "Don't Touch"
 LAYER_NAME_LADDERS = "Ladders"
 LAYER_NAME_PLAYER = "Player"
 
+# The window runs the game logic in fixed steps at PHYSICS_RATE a second.
+# It updates at RENDER_RATE a second. arcade.run draws at pyglet's 60 a
+# second, so main runs its own loop at any other RENDER_RATE. A slow frame
+# runs at most MAX_PHYSICS_STEPS steps to catch up.
+PHYSICS_RATE = 60
+RENDER_RATE = 60
+MAX_PHYSICS_STEPS = 5
+
+# Sprites that move further than this in one step are drawn where they
+# landed instead of sliding there, as after a respawn
+SNAP_DISTANCE = GRID_PIXEL_SIZE * 4
+
+# Phases of Game.update, in the order they run
+UPDATE_PHASES = (
+    "velocity",
+    "player animation",
+    "physics",
+    "tile animation",
+    "platforms",
+    "coins",
+    "fall",
+    "camera",
+)
+
+# Set to a .csv or .json file name to profile from the start and dump there at exit
+PROFILE_ENV = "PLATFORMER_PROFILE"
+
+# Set to a file name to record the keys pressed and released, by physics
+# step, and write them there at exit for headless.py --replay
+RECORD_ENV = "PLATFORMER_RECORD"
+
+# Layer specific options are defined on Layer names in a dictionary
+# Doing this will make the SpriteList for the platforms layer
+# use spatial hashing for detection.
+LAYER_OPTIONS = {
+    LAYER_NAME_PLATFORMS: {
+        "use_spatial_hash": True,
+    },
+    LAYER_NAME_MOVING_PLATFORMS: {
+        "use_spatial_hash": False,
+    },
+    LAYER_NAME_COINS: {
+        "use_spatial_hash": True,
+    },
+    LAYER_NAME_DONT_TOUCH: {
+        "use_spatial_hash": True,
+    },
+}
+
+# Layers that never move, drawn in the chunks of a SceneChunks
+CHUNKED_LAYERS = (
+    LAYER_NAME_PLATFORMS,
+    LAYER_NAME_COINS,
+    LAYER_NAME_FOREGROUND,
+    LAYER_NAME_BACKGROUND,
+    LAYER_NAME_DONT_TOUCH,
+    LAYER_NAME_LADDERS,
+)
+
+# Layers whose animated tiles are stepped together by a TileAnimator
+ANIMATED_LAYERS = (LAYER_NAME_COINS, LAYER_NAME_BACKGROUND)
+
 
 def load_texture_pair(filename):
     """Load a texture pair, with the second being a mirror image."""
@@ -51,72 +138,106 @@ def load_texture_pair(filename):
     ]
 
 
-class PhysicsEngine(arcade.PhysicsEnginePlatformer):
-    """A slightly modified platformer physics engine."""
-    def can_jump(self, y_distance: float = 5, x_distance: float = 5) -> bool:
-        """
-        Method that looks to see if there is a floor under or if the player can wall jump.
-
-        :returns: True if there is a platform below us
-        :rtype: bool
-        """
-
-        # Move down to see if we are on a platform
-        self.player_sprite.center_y -= y_distance
-
-        # Check for wall hit
-        y_hit_list = arcade.check_for_collision_with_lists(
-            self.player_sprite, self.walls + self.platforms
-        )
-
-        self.player_sprite.center_y += y_distance
-
-        # Move left to see if we are next to a wall
-        self.player_sprite.center_x -= x_distance
-
-        # Check for left wall hit
-        left_hit_list = arcade.check_for_collision_with_lists(
-            self.player_sprite, self.walls + self.platforms
-        )
-
-        self.player_sprite.center_x += x_distance
-
-        # Move right to see if we are next to a wall
-        self.player_sprite.center_x += x_distance
-
-        # Check for left wall hit
-        right_hit_list = arcade.check_for_collision_with_lists(
-            self.player_sprite, self.walls + self.platforms
-        )
-
-        self.player_sprite.center_x -= x_distance
-
-        possible = (len(y_hit_list) > 0,
-                    len(left_hit_list) > 0,
-                    len(right_hit_list) > 0)
-
-        return True in possible
-
-
-class FPSCounter:
-    """A class to detect frames per second."""
+class HUD:
+    """A class to keep one persistent text object per GUI label."""
     def __init__(self):
-        self.time = time.perf_counter()
-        self.frame_times = collections.deque(maxlen=60)
-
-    def tick(self):
-        """Determine tick amount."""
-        t_1 = time.perf_counter()
-        dt = t_1 - self.time
-        self.time = t_1
-        self.frame_times.append(dt)
-
-    def get_fps(self) -> float:
-        """Return FPS as a float."""
-        total_time = sum(self.frame_times)
-        if total_time == 0:
-            return 0
-        return len(self.frame_times) / sum(self.frame_times)
+        self.labels = {}
+        self.values = {}
+
+        # Retained GUI shapes, drawn as a single batch
+        self.shapes = arcade.ShapeElementList()
+
+    def build_shapes(self, width: int, height: int):
+        """Build the GUI shapes for a window size."""
+        self.shapes = arcade.ShapeElementList()
+        self.shapes.append(arcade.create_rectangle_filled(
+            center_x=width / 14,
+            center_y=height - height / 10,
+            width=width / 7,
+            height=height / 4,
+            color=arcade.color.IRRESISTIBLE,
+        ))
+
+    def set_label(self, text: str, var: any, x: float, y: float):
+        """Set a label's value and place, only laying out its glyphs again on change."""
+        value = f"{text}: {var}"
+        label = self.labels.get(text)
+        if label is not None and label.position != (x, y):
+            label.position = x, y
+        if self.values.get(text) == value:
+            return
+        self.values[text] = value
+        if label is not None:
+            label.text = value
+        else:
+            self.labels[text] = arcade.Text(
+                text=value,
+                start_x=x, start_y=y,
+                color=arcade.csscolor.WHITE,
+                font_size=18,
+            )
+
+    def draw(self):
+        """Draw the shapes and every label."""
+        self.shapes.draw()
+        for label in self.labels.values():
+            label.draw()
+
+
+class RenderInterpolator:
+    """A class to draw sprites between where the last two physics steps left them."""
+    def __init__(self, sprites: list = ()):
+        self.sprites = list(sprites)
+        self.previous = []
+        self.current = []
+        self.save()
+
+    def save(self):
+        """Record where the sprites are before a physics step."""
+        self.previous = [sprite.position for sprite in self.sprites]
+
+    def apply(self, alpha: float):
+        """Move the sprites alpha of the way from their previous positions, until restore."""
+        self.current = [sprite.position for sprite in self.sprites]
+        for sprite, (old_x, old_y), (new_x, new_y) in zip(
+                self.sprites, self.previous, self.current):
+            if (old_x, old_y) == (new_x, new_y) or \
+                    abs(new_x - old_x) > SNAP_DISTANCE or abs(new_y - old_y) > SNAP_DISTANCE:
+                continue
+            sprite.position = old_x + (new_x - old_x) * alpha, old_y + (new_y - old_y) * alpha
+
+    def restore(self):
+        """Put the sprites back where the physics left them."""
+        for sprite, position in zip(self.sprites, self.current):
+            sprite.position = position
+
+
+class SceneSnapshot:
+    """A class to restore a Scene's sprites to the state they were saved in."""
+    def __init__(self, scene: arcade.Scene, skip: tuple = ()):
+        self.layers = []
+        for name, sprite_list in scene.name_mapping.items():
+            if name in skip:
+                continue
+            self.layers.append((sprite_list, [
+                (sprite, sprite.position, sprite.change_x, sprite.change_y,
+                 sprite.texture, getattr(sprite, "cur_frame_idx", None))
+                for sprite in sprite_list
+            ]))
+
+    def restore(self):
+        """Put back removed sprites and restore every saved sprite's state."""
+        for sprite_list, states in self.layers:
+            for sprite, position, change_x, change_y, texture, frame in states:
+                if sprite_list not in sprite.sprite_lists:
+                    sprite_list.append(sprite)
+                sprite.position = position
+                sprite.change_x, sprite.change_y = change_x, change_y
+                if sprite.texture is not texture:
+                    sprite.texture = texture
+                if frame is not None:
+                    sprite.cur_frame_idx = frame
+                    sprite.time_counter = 0.0
 
 
 class Player(arcade.Sprite):
@@ -126,15 +247,12 @@ class Player(arcade.Sprite):
         super().__init__()
 
         self.character_face_direction = RIGHT_FACING
-
-        # Flipping images
-        self.cur_texture = 0
         self.scale = CHARACTER_SCALING
 
         # Tracking state
-        self.jumping = False
-        self.climbing = False
         self.is_on_ladder = False
+        self.state = IDLE
+        self.animation_time = 0.0
 
         # --- Load Textures ---
 
@@ -159,75 +277,64 @@ class Player(arcade.Sprite):
         # Hit box will be set based on the first image used.
         # Alternate ideas:
         # [[-22, -64], [22, -64], [22, 28], [-22, 28]]
-        self.hit_box = self.texture.hit_box_points
+        self.hit_box = HIT_BOXES.fill(self.texture)
+
+        # Frames of each state, for each facing direction
+        self.animations = {
+            IDLE: tuple((texture,) for texture in self.idle_texture_pair),
+            JUMP: tuple((texture,) for texture in self.jump_texture_pair),
+            WALK: tuple(tuple(pair[facing] for pair in self.walk_textures)
+                        for facing in (RIGHT_FACING, LEFT_FACING)),
+            CLIMB: (tuple(self.climbing_textures),) * 2,
+        }
 
-    def show_direction(self):
-        """Show player's direction."""
-        if self.change_x < 0 and self.character_face_direction == RIGHT_FACING:
-            self.character_face_direction = LEFT_FACING
-        elif self.change_x > 0 and self.character_face_direction == LEFT_FACING:
-            self.character_face_direction = RIGHT_FACING
-        return True
-
-    def show_climbing(self):
-        """Shows climbing animation"""
-        if self.is_on_ladder:
-            self.climbing = True
-        if not self.is_on_ladder and self.climbing:
-            self.climbing = False
-        if self.climbing and abs(self.change_y) > 1:
-            self.cur_texture += 1
-            if self.cur_texture > 7:
-                self.cur_texture = 0
-        if self.climbing:
-            self.texture = self.climbing_textures[self.cur_texture // 4]
-            return True
-
-    def show_jumping(self):
-        """Shows jumping animation."""
-        if self.change_y != 0 and not self.is_on_ladder and not self.jumping:
-            self.texture = self.jump_texture_pair[self.character_face_direction]
-            return True
-
-    def show_idle(self):
-        """Shows idle animation."""
-        if self.change_x == 0 and not self.climbing:
-            self.texture = self.idle_texture_pair[self.character_face_direction]
-            return True
-
-    def show_walking(self):
-        """Shows walking animation."""
-        self.cur_texture += 1
-        if self.cur_texture > 7:
-            self.cur_texture = 0
-        self.texture = self.walk_textures[self.cur_texture][
-            self.character_face_direction
-        ]
-        return True
+    @property
+    def all_textures(self) -> list:
+        """Every animation frame of the player."""
+        textures = [*self.idle_texture_pair, *self.jump_texture_pair,
+                    *self.fall_texture_pair, *self.climbing_textures]
+        for texture_pair in self.walk_textures:
+            textures.extend(texture_pair)
+        return textures
+
+    def add_textures_to_atlas(self, atlas: arcade.TextureAtlas):
+        """Pack every animation frame into the atlas up front."""
+        for texture in self.all_textures:
+            atlas.add(texture)
 
     def update_animation(self, delta_time: float = 1 / 60):
         """Updates the player animation."""
         self.left = max(self.left, 0) # Check for out of bounds on the left
 
-        self.show_direction()
-        if self.show_climbing():
-            return
-        if self.show_jumping():
-            return
-        if self.show_idle():
-            return
-        self.show_walking()
+        if self.change_x < 0:
+            self.character_face_direction = LEFT_FACING
+        elif self.change_x > 0:
+            self.character_face_direction = RIGHT_FACING
+
+        state, advancing = PLAYER_STATES[
+            self.is_on_ladder, self.change_y != 0, self.change_x != 0]
+        if state != self.state:
+            self.state = state
+            self.animation_time = 0.0
+        elif advancing:
+            self.animation_time += delta_time
+
+        # Only a new state or frame changes the texture. The nudge keeps the
+        # rounding of summed frame times from holding a frame back a tick.
+        frames = self.animations[state][self.character_face_direction]
+        frame = int(self.animation_time / PLAYER_FRAME_TIMES[state] + 1e-6)
+        texture = frames[frame % len(frames)]
+        if texture is not self.texture:
+            self.texture = texture
 
 
-class MyGame(arcade.Window):
+class Game:
     """
-    Main application class.
+    Game state and logic, kept apart from the window so it can run headless.
     """
 
     def __init__(self):
-        """Call the parent class and set up the window."""
-        super().__init__(SCREEN_WIDTH, SCREEN_HEIGHT, SCREEN_TITLE)
-
+        """Set up the game state."""
         # Set the path to start with this program
         file_path = os.path.dirname(os.path.abspath(__file__))
         os.chdir(file_path)
@@ -250,7 +357,10 @@ class MyGame(arcade.Window):
         self.score = 0
         self.lives_left = 0
         self.timer = 0
-        self.fps = FPSCounter()
+
+        # Physics steps run, and the keys recorded against them if recording
+        self.tick = 0
+        self.recording = None
 
         # Keys are set as a tuple for easier access
         self.vertical = (key.UP, key.W, key.DOWN, key.S)
@@ -267,47 +377,70 @@ class MyGame(arcade.Window):
 
         self.level = 1
 
+        # Scene state saved by setup, used to restart without reloading
+        self.snapshot = None
+
+        # Lookups built from the layers when the map is loaded
+        self.coin_grid = None
+        self.tile_animator = None
+        self.platform_mover = None
+
+        # Tile layers to create only near the camera, none by default
+        self.stream_layers = ()
+        self.streamer = None
+
+        # Walls merged into boxes for the physics, off for arcade's own engine
+        self.merge_walls = True
+
+        # Options for each layer of the TileMap
+        self.layer_options = LAYER_OPTIONS
+
+        # Opt-in timing of each update phase
+        self.profiler = FrameProfiler(UPDATE_PHASES)
+
+        # What each of UPDATE_PHASES runs, given the tick's delta_time
+        self.update_phases = (
+            lambda _: self.update_player_velocity(),
+            self.step_player_animation,
+            lambda _: self.physics_engine.update(),
+            self.step_tile_animation,
+            lambda _: self.platform_mover.update(),
+            lambda _: self.player_coin_collision(),
+            lambda _: self.fell_off_map(),
+            lambda _: self.update_camera(),
+        )
+
         # Load sounds
         self.collect_coin_sound = arcade.load_sound(":resources:sounds/coin1.wav")
         self.jump_sound = arcade.load_sound(":resources:sounds/jump1.wav")
         self.game_over_sound = arcade.load_sound(":resources:sounds/gameover1.wav")
 
-        arcade.set_background_color(arcade.csscolor.CORNFLOWER_BLUE)
-
     def setup(self):
-        """Set-up the game here. Call this function to restart the game."""
+        """
+        Set-up the game here. Call this function to restart the game.
 
-        # Setup the Cameras
-        self.camera = arcade.Camera(self.width, self.height)
-        self.gui_camera = arcade.Camera(self.width, self.height)
+        Use reset instead to restart without reloading the map.
+        The camera must be created before this is called.
+        """
 
         # Name of map file to load
         map_name = ":resources:tiled_maps/map_with_ladders.json"
 
-        # Layer specific options are defined on Layer names in a dictionary
-        # Doing this will make the SpriteList for the platforms layer
-        # use spatial hashing for detection.
-        layer_options = {
-            LAYER_NAME_PLATFORMS: {
-                "use_spatial_hash": True,
-            },
-            LAYER_NAME_MOVING_PLATFORMS: {
-                "use_spatial_hash": False,
-            },
-            LAYER_NAME_COINS: {
-                "use_spatial_hash": True,
-            },
-            LAYER_NAME_DONT_TOUCH: {
-                "use_spatial_hash": True,
-             },
-        }
-
         # Read in tiled map
-        self.tile_map = arcade.load_tilemap(map_name, TILE_SCALING, layer_options)
+        if self.stream_layers:
+            self.streamer = TileStreamer(map_name, TILE_SCALING, self.layer_options,
+                                         self.stream_layers)
+            self.tile_map = self.streamer.tile_map
+        else:
+            self.streamer = None
+            self.tile_map = load_map(map_name, TILE_SCALING, self.layer_options)
 
         # Initialize Scene
         # Automatically adds all layers as SpriteLists in proper order.
-        self.scene = arcade.Scene.from_tilemap(self.tile_map)
+        if self.streamer:
+            self.scene = self.streamer.build_scene()
+        else:
+            self.scene = arcade.Scene.from_tilemap(self.tile_map)
 
         self.player_sprite = Player()
         self.player_sprite.center_x = PLAYER_START_X
@@ -318,86 +451,104 @@ class MyGame(arcade.Window):
         self.score = 0
         self.lives_left = 5
 
-        # --- Other stuff
-        # Set the background color
-        if self.tile_map.background_color:
-            arcade.set_background_color(self.tile_map.background_color)
-
         # Calculate the right edge of the my_map in pixels
         self.end_of_map = self.tile_map.width * GRID_PIXEL_SIZE
 
         # Create the physics engine
+        # The layers are passed in lists, as the engine drops an empty
+        # SpriteList and a streamed layer starts out empty.
         self.physics_engine = PhysicsEngine(
             self.player_sprite,
-            platforms=self.scene[LAYER_NAME_MOVING_PLATFORMS],
+            platforms=[self.scene[LAYER_NAME_MOVING_PLATFORMS]],
             gravity_constant=GRAVITY,
-            ladders=self.scene[LAYER_NAME_LADDERS],
-            walls=self.scene[LAYER_NAME_PLATFORMS]
+            ladders=[self.scene[LAYER_NAME_LADDERS]],
+            walls=[self.scene[LAYER_NAME_PLATFORMS]],
+            merge_walls=self.merge_walls,
+            moving_platforms=False,
+            continuous=self.merge_walls,
         )
 
-    @property
-    def current_fps(self) -> float:
-        """Determine current fps."""
-        return self.fps.get_fps()
+        self.index_scene()
 
-    @property
-    def coins_left(self) -> int:
-        """Determine coins remaining."""
-        return len(self.scene["Coins"])
+        # Save the starting state of every layer for reset
+        self.snapshot = SceneSnapshot(self.scene, skip=(LAYER_NAME_PLAYER, *self.stream_layers))
 
-    @staticmethod
-    def gui_label(text: str, var: any, x: int, y: int):
-        """
-        Simplify arcade.draw_text.
+        if self.streamer:
+            self.center_camera_to_player()
+            self.stream_tiles()
 
-        Keyword arguments:
-        text -- This is the label.
-        var -- This is the variable value.
-        x -- This is the percent point of the screen's x x that it will start at.
-        y -- This is the percent point of the screen's y it will start at.
-        """
-        x, y = x / 100, y / 100
-        arcade.draw_text(
-            text=f"{text}: {var}",
-            start_x=SCREEN_WIDTH * x, start_y=SCREEN_HEIGHT * y,
-            color=arcade.csscolor.WHITE,
-            font_size=18,
-        )
+        # Keep any hit box calculated while loading for the next start
+        HIT_BOXES.save()
 
-    def display_gui_info(self):
-        """Display GUI information."""
-        arcade.draw_rectangle_filled(center_x=SCREEN_WIDTH / 14,
-                                     center_y=SCREEN_HEIGHT - SCREEN_HEIGHT / 10,
-                                     width=SCREEN_WIDTH / 7,
-                                     height=SCREEN_HEIGHT / 4,
-                                     color=arcade.color.IRRESISTIBLE,
-                                     )
-        self.gui_label("Score", self.score, 0, 95)
-        self.gui_label("Coins Left", self.coins_left, 0, 90)
-        self.gui_label("Time", round(self.timer), 0, 85)
-        self.gui_label("Lives", self.lives_left, 0, 80)
-        self.gui_label("FPS", round(self.current_fps), 90, 95)
+    def reset(self):
+        """Restart the game from the snapshot saved in setup."""
+        self.snapshot.restore()
+        if self.streamer:
+            self.streamer.reset()
 
-    def on_draw(self):
-        """Render the screen."""
-        # Clears screen to the background color
-        arcade.start_render()
+        # Collected coins are back in the scene
+        self.index_scene()
 
-        # Activate our Camera
-        self.camera.use()
+        self.stop_player()
+        self.reset_player()
+        self.player_sprite.is_on_ladder = False
+        self.player_sprite.state = IDLE
+        self.player_sprite.animation_time = 0.0
+        self.player_sprite.character_face_direction = RIGHT_FACING
+        self.player_sprite.texture = self.player_sprite.idle_texture_pair[RIGHT_FACING]
+        self.left_pressed = False
+        self.right_pressed = False
 
-        # Draw scene
-        self.scene.draw()
+        # Set up game information for GUI
+        self.score = 0
+        self.lives_left = 5
 
-        # Activate GUI camera before elements.
-        self.gui_camera.use()
+        self.camera.move_to((0, 0), 1)
+        if self.streamer:
+            self.stream_tiles()
 
-        # Draw score while scrolling it along the screen.
-        self.display_gui_info()
-        self.fps.tick()
+    def index_scene(self):
+        """Build the lookups for the layers of the loaded scene."""
+        self.coin_grid = CoinGrid(self.scene[LAYER_NAME_COINS])
+        self.tile_animator = self.animate_tiles()
+        self.platform_mover = PlatformMover(self.scene[LAYER_NAME_MOVING_PLATFORMS])
+
+    def animate_tiles(self) -> TileAnimator:
+        """Return a TileAnimator for the animated tiles in the scene."""
+        return TileAnimator([self.scene[name] for name in ANIMATED_LAYERS
+                             if name in self.scene.name_mapping])
+
+    def stream_tiles(self):
+        """Load the tiles near where the camera is heading and release far ones."""
+        camera = self.camera
+        added, removed = self.streamer.update(*camera.goal_position, camera.viewport_width,
+                                              camera.viewport_height)
+
+        for coin in removed.get(LAYER_NAME_COINS, ()):
+            self.coin_grid.remove(coin)
+        for coin in added.get(LAYER_NAME_COINS, ()):
+            self.coin_grid.add(coin)
+
+        if any(name in added or name in removed for name in ANIMATED_LAYERS):
+            self.tile_animator.sync()
+            self.tile_animator = self.animate_tiles()
+
+        if LAYER_NAME_LADDERS in added or LAYER_NAME_LADDERS in removed:
+            self.physics_engine.build_ladder_columns()
+
+        walls_changed = LAYER_NAME_PLATFORMS in added or LAYER_NAME_PLATFORMS in removed
+        if walls_changed and self.physics_engine.static_rects:
+            self.physics_engine.build_static_rects()
+
+    @property
+    def coins_left(self) -> int:
+        """Determine coins remaining."""
+        return len(self.scene["Coins"])
 
     def on_key_press(self, button: int, modifiers: int):
         """Called whenever a key is pressed."""
+        if self.recording is not None:
+            self.recording.record(self.tick, button, True)
         if button in self.up:
             if self.physics_engine.is_on_ladder():
                 self.player_sprite.change_y = PLAYER_MOVEMENT_SPEED
@@ -413,9 +564,13 @@ class MyGame(arcade.Window):
             self.left_pressed = True
         elif button in self.right:
             self.right_pressed = True
+        elif button == key.R:
+            self.reset()
 
     def on_key_release(self, button: int, modifiers: int):
         """Called when the user releases a key."""
+        if self.recording is not None:
+            self.recording.record(self.tick, button, False)
         if button in self.vertical and self.physics_engine.is_on_ladder():
             self.player_sprite.change_y = 0
         else:
@@ -453,21 +608,21 @@ class MyGame(arcade.Window):
         Detects player collision with coins, then removes the coin sprite.
         This will play a sound and add 1 to the score.
         """
-        # Detect coin collision
-        coin_hit_list = arcade.check_for_collision_with_list(
-            self.player_sprite, self.scene[LAYER_NAME_COINS]
-        )
+        # Detect coin collision in the grid cells under the player
+        coin_hit_list = self.coin_grid.collisions(self.player_sprite)
 
         # Loop through each coin we hit and remove it
         for coin in coin_hit_list:
             # Figure out point value
-            if "Points" not in coin.properties:
+            points = self.coin_grid.points[coin]
+            if points is None:
                 print("Warning, collected a coin without a Points property.")
             else:
-                points = int(coin.properties["Points"])
                 self.score += points
 
             # Remove the coin and add to score
+            self.coin_grid.remove(coin)
+            self.tile_animator.remove(coin)
             coin.remove_from_sprite_lists()
             arcade.play_sound(self.collect_coin_sound)
 
@@ -509,33 +664,277 @@ class MyGame(arcade.Window):
             # Load the next level
             self.setup()
 
+    def step_player_animation(self, delta_time: float):
+        """Step the player's animation."""
+        self.player_sprite.update_animation(delta_time)
+
+    def step_tile_animation(self, delta_time: float):
+        """Step the animated tiles."""
+        self.tile_animator.update(delta_time)
+
+    def update_camera(self):
+        """Position the camera, and stream the tiles around it if streaming."""
+        self.center_camera_to_player()
+        if self.streamer:
+            self.stream_tiles()
+
     def update(self, delta_time: float):
         """Movement and game logic."""
         self.timer += delta_time
+        self.tick += 1
+        if self.profiler.enabled:
+            self.update_profiled(delta_time)
+            return
 
-        # Move the player with the physics engine
-        self.update_player_velocity()
-        self.player_sprite.update_animation()
-        self.physics_engine.update()
+        for phase in self.update_phases:
+            phase(delta_time)
 
-        self.scene.update_animation(
-            delta_time, [LAYER_NAME_COINS, LAYER_NAME_BACKGROUND]
-        )
-        self.scene.update([LAYER_NAME_MOVING_PLATFORMS])
+    def update_profiled(self, delta_time: float):
+        """Run the same phases as update, timing each one."""
+        profiler = self.profiler
+        profiler.start()
+        for phase in self.update_phases:
+            phase(delta_time)
+            profiler.mark()
+        profiler.finish()
 
-        # Detect collisions and level state
-        self.player_coin_collision()
-        self.fell_off_map()
 
-        # Position the camera
-        self.center_camera_to_player()
+class MyGame(Game, arcade.Window):
+    """
+    Main application class.
+    """
+
+    def __init__(self):
+        """Call the parent classes and set up the window."""
+        arcade.Window.__init__(self, SCREEN_WIDTH, SCREEN_HEIGHT, SCREEN_TITLE,
+                               update_rate=1 / RENDER_RATE)
+        Game.__init__(self)
+
+        # Game time not yet run by a physics step, and the sprites drawn
+        # part way between steps
+        self.physics_timestep = 1 / PHYSICS_RATE
+        self.accumulator = 0.0
+        self.interpolator = RenderInterpolator()
+
+        self.fps = FPSCounter()
+        self.hud = HUD()
+        self.profiler_hud = HUD()
+
+        # Static layers split up so only what the camera sees is drawn
+        self.chunks = None
+
+        # Profile from the start if a dump file is given
+        self.profile_file = os.environ.get(PROFILE_ENV)
+        self.profiler.enabled = bool(self.profile_file)
+
+        # Record the keys if a file is given
+        self.record_file = os.environ.get(RECORD_ENV)
+        if self.record_file:
+            self.recording = InputRecording(self.physics_timestep)
+
+        arcade.set_background_color(arcade.csscolor.CORNFLOWER_BLUE)
+
+    def setup(self):
+        """Set-up the game here. Call this function to restart the game."""
+
+        # Setup the Cameras
+        self.camera = arcade.Camera(self.width, self.height)
+        self.gui_camera = arcade.Camera(self.width, self.height)
+
+        super().setup()
+
+        # Animation switching then never has to add to the atlas mid-game
+        self.player_sprite.add_textures_to_atlas(
+            self.scene[LAYER_NAME_PLAYER].atlas)
+
+        # --- Other stuff
+        # Set the background color
+        if self.tile_map.background_color:
+            arcade.set_background_color(self.tile_map.background_color)
+
+        # Streamed layers only ever hold the tiles near the camera
+        self.chunks = SceneChunks(
+            self.scene, [name for name in CHUNKED_LAYERS if name not in self.stream_layers])
+
+        self.hud.build_shapes(self.width, self.height)
+        self.update_gui_info()
+
+    def reset(self):
+        """Restart the game from the snapshot saved in setup."""
+        super().reset()
+        # The snapshot put back the same sprites, so the chunks only need the removed ones
+        self.chunks.restore()
+        self.update_gui_info()
+
+    def index_scene(self):
+        """Build the lookups for the layers, and the interpolation of what moves."""
+        super().index_scene()
+
+        self.accumulator = 0.0
+        self.interpolator = RenderInterpolator(
+            [self.player_sprite, *self.scene[LAYER_NAME_MOVING_PLATFORMS]])
+
+    def on_resize(self, width: int, height: int):
+        """Fit the cameras and the GUI to the new window size."""
+        super().on_resize(width, height)
+        # pyglet can send this from Window.__init__, before the GUI exists
+        if getattr(self, "hud", None) is not None:
+            self.hud.build_shapes(width, height)
+        if getattr(self, "gui_camera", None) is not None:
+            self.camera.resize(width, height)
+            self.gui_camera.resize(width, height)
+            self.update_gui_info()
+
+    @property
+    def current_fps(self) -> float:
+        """Determine current fps."""
+        return self.fps.get_fps()
+
+    def gui_label(self, text: str, var: any, x: int, y: int):
+        """
+        Set a GUI label's text.
+
+        Keyword arguments:
+        text -- This is the label.
+        var -- This is the variable value.
+        x -- This is the percent point of the GUI camera's x that it will start at.
+        y -- This is the percent point of the GUI camera's y it will start at.
+        """
+        x, y = x / 100, y / 100
+        self.hud.set_label(text, var, self.gui_camera.viewport_width * x,
+                           self.gui_camera.viewport_height * y)
+
+    def update_gui_info(self):
+        """Update GUI information."""
+        self.gui_label("Score", self.score, 0, 95)
+        self.gui_label("Coins Left", self.coins_left, 0, 90)
+        self.gui_label("Time", round(self.timer), 0, 85)
+        self.gui_label("Lives", self.lives_left, 0, 80)
+        self.gui_label("FPS", round(self.current_fps), 90, 95)
+
+        # Refresh the profiler overlay twice a second
+        if self.profiler.enabled and self.profiler.index % 30 == 0:
+            summary = self.profiler.summary()
+            for i, phase in enumerate(UPDATE_PHASES):
+                self.profiler_hud.set_label(
+                    phase, f"{summary[phase]['mean_us']:.0f} us",
+                    self.gui_camera.viewport_width * 0.7,
+                    self.gui_camera.viewport_height * (0.85 - i * 0.04))
+
+    def display_gui_info(self):
+        """Display GUI information."""
+        self.hud.draw()
+        if self.profiler.enabled:
+            self.profiler_hud.draw()
+
+    def on_draw(self):
+        """Render the screen."""
+        # Clears screen to the background color
+        arcade.start_render()
+
+        # Activate our Camera
+        self.camera.use()
+
+        # Draw the part of the scene in view, with moving sprites part way
+        # into the physics step still to come
+        self.interpolator.apply(self.accumulator / self.physics_timestep)
+        self.chunks.draw(*self.camera.position, self.camera.viewport_width,
+                         self.camera.viewport_height)
+        self.interpolator.restore()
+
+        # Activate GUI camera before elements.
+        self.gui_camera.use()
+
+        # Draw score while scrolling it along the screen.
+        self.display_gui_info()
+        self.fps.tick()
+
+    def on_key_press(self, button: int, modifiers: int):
+        """Called whenever a key is pressed."""
+        if button == key.F3:
+            # Toggle the profiler and its overlay
+            self.profiler.enabled = not self.profiler.enabled
+        else:
+            super().on_key_press(button, modifiers)
+
+    def on_close(self):
+        """Dump the profile and the input, if asked for, save the hit boxes and close the window."""
+        # A file that can't be written doesn't keep the window open
+        if self.profile_file:
+            try:
+                self.profiler.dump(self.profile_file)
+            except OSError as error:
+                print(f"Warning, the profile wasn't written: {error}")
+        if self.record_file:
+            self.recording.ticks = self.tick
+            try:
+                self.recording.save(self.record_file)
+            except (OSError, struct.error) as error:
+                print(f"Warning, the input recording wasn't written: {error}")
+        HIT_BOXES.save()
+        super().on_close()
+
+    def update(self, delta_time: float):
+        """Run the game logic in fixed steps for the time since the last frame."""
+        self.accumulator += delta_time
+        steps = 0
+        while self.accumulator >= self.physics_timestep and steps < MAX_PHYSICS_STEPS:
+            self.interpolator.save()
+            super().update(self.physics_timestep)
+            # A reset inside the step already started the accumulator over
+            self.accumulator = max(self.accumulator - self.physics_timestep, 0.0)
+            steps += 1
+
+        # Drop whole steps too far behind to catch up on
+        if steps == MAX_PHYSICS_STEPS:
+            self.accumulator %= self.physics_timestep
+        self.update_gui_info()
+
+
+@contextlib.contextmanager
+def timer_resolution(msecs: int):
+    """Ask Windows for a finer timer, as arcade.run does, so a draw isn't held up to 15 ms."""
+    # pylint: disable=import-outside-toplevel,too-few-public-methods
+    import ctypes
+    from ctypes import wintypes
+
+    class TimeCaps(ctypes.Structure):
+        """The TIMECAPS the timer range is read into."""
+        _fields_ = (("wPeriodMin", wintypes.UINT), ("wPeriodMax", wintypes.UINT))
+
+    winmm = ctypes.WinDLL("winmm")
+    caps = TimeCaps()
+    winmm.timeGetDevCaps(ctypes.byref(caps), ctypes.sizeof(caps))
+    msecs = min(max(msecs, caps.wPeriodMin), caps.wPeriodMax)
+    if winmm.timeBeginPeriod(msecs):
+        raise OSError(f"timeBeginPeriod({msecs}) failed")
+    try:
+        yield
+    finally:
+        winmm.timeEndPeriod(msecs)
+
+
+def run_at_rate(interval: float):
+    """Run the event loop as arcade.run does, drawing every interval seconds."""
+    window = arcade.get_window()
+    if os.environ.get("ARCADE_TEST") or window.headless:
+        # arcade's own loops for these don't wait for a draw
+        arcade.run()
+    elif sys.platform != "win32":
+        pyglet.app.run(interval)
+    else:
+        with timer_resolution(10):
+            pyglet.app.run(interval)
 
 
 def main():
     """Main program code."""
     window = MyGame()
     window.setup()
-    arcade.run()
+    if RENDER_RATE == 60:
+        arcade.run()
+    else:
+        run_at_rate(1 / RENDER_RATE)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,461 @@
+#! /usr/bin/env python3
+"""benchmark.py - Time the hot paths of each stage without a window."""
+
+import argparse
+import json
+import statistics
+import time
+import types
+
+import arcade
+
+import add_coins_and_sound
+import add_gravity
+import animate_characters
+import camera
+import display_the_score
+import draw_sprites
+import headless
+import ladders_animated_moving_platforms
+import load_a_map
+import map_cache
+import multiple_levels
+import open_window
+import scene_object
+import user_control
+
+# Sizes every benchmark is run at
+MAP_TILES = (64, 512, 4096)
+SPRITE_COUNTS = (10, 100, 1000)
+QUICK_MAP_TILES = (64, 512)
+QUICK_SPRITE_COUNTS = (10, 100)
+
+# Maps bundled with arcade, smallest to largest
+MAP_NAMES = (
+    ":resources:tiled_maps/map.json",
+    ":resources:tiled_maps/map_with_ladders.json",
+    ":resources:tiled_maps/map2_level_1.json",
+)
+
+GROUND_TEXTURE = ":resources:images/tiles/grassMid.png"
+COIN_TEXTURE = ":resources:images/items/coinGold.png"
+LADDER_TEXTURE = ":resources:images/tiles/ladderMid.png"
+COIN_FRAME_TEXTURE = ":resources:images/items/coinSilver.png"
+TILE_SIZE = animate_characters.GRID_PIXEL_SIZE
+
+
+def build_game(map_tiles: int, coins: int) -> headless.HeadlessGame:
+    """
+    Build a headless game on a flat map.
+
+    The map is a ground row map_tiles wide with a wall at each end and
+    coins spread evenly above the ground.
+    """
+    game = headless.HeadlessGame()
+    game.camera = headless.HeadlessCamera(animate_characters.SCREEN_WIDTH,
+                                          animate_characters.SCREEN_HEIGHT)
+    game.scene = arcade.Scene()
+
+    walls = arcade.SpriteList(use_spatial_hash=True)
+    for i in range(map_tiles):
+        tile = arcade.Sprite(GROUND_TEXTURE, animate_characters.TILE_SCALING)
+        tile.position = i * TILE_SIZE + TILE_SIZE / 2, TILE_SIZE / 2
+        walls.append(tile)
+    for x in (-TILE_SIZE / 2, map_tiles * TILE_SIZE + TILE_SIZE / 2):
+        tile = arcade.Sprite(GROUND_TEXTURE, animate_characters.TILE_SCALING)
+        tile.position = x, TILE_SIZE * 1.5
+        walls.append(tile)
+    game.scene.add_sprite_list(animate_characters.LAYER_NAME_PLATFORMS, sprite_list=walls)
+
+    coin_list = arcade.SpriteList(use_spatial_hash=True)
+    spacing = map_tiles * TILE_SIZE / max(coins, 1)
+    for i in range(coins):
+        coin = arcade.Sprite(COIN_TEXTURE, animate_characters.COIN_SCALING)
+        coin.position = (i + 0.5) * spacing, TILE_SIZE * 4
+        coin.properties["Points"] = "1"
+        coin_list.append(coin)
+    game.scene.add_sprite_list(animate_characters.LAYER_NAME_COINS, sprite_list=coin_list)
+
+    for name in (animate_characters.LAYER_NAME_MOVING_PLATFORMS,
+                 animate_characters.LAYER_NAME_LADDERS,
+                 animate_characters.LAYER_NAME_BACKGROUND,
+                 animate_characters.LAYER_NAME_DONT_TOUCH):
+        game.scene.add_sprite_list(name, use_spatial_hash=True)
+
+    game.player_sprite = animate_characters.Player()
+    game.player_sprite.position = TILE_SIZE * 2, TILE_SIZE + game.player_sprite.height / 2
+    game.scene.add_sprite(animate_characters.LAYER_NAME_PLAYER, game.player_sprite)
+    game.end_of_map = map_tiles * TILE_SIZE
+    game.index_scene()
+
+    game.physics_engine = animate_characters.PhysicsEngine(
+        game.player_sprite,
+        platforms=game.scene[animate_characters.LAYER_NAME_MOVING_PLATFORMS],
+        gravity_constant=animate_characters.GRAVITY,
+        ladders=game.scene[animate_characters.LAYER_NAME_LADDERS],
+        walls=walls,
+        merge_walls=True,
+        moving_platforms=False,
+    )
+    return game
+
+
+def moving_sprites(count: int) -> arcade.SpriteList:
+    """A SpriteList of sprites with a velocity, like a Moving Platforms layer."""
+    sprite_list = arcade.SpriteList()
+    for i in range(count):
+        sprite = arcade.Sprite(GROUND_TEXTURE, animate_characters.TILE_SCALING)
+        sprite.position = i * TILE_SIZE, TILE_SIZE * 3
+        sprite.change_x = 1
+        sprite.boundary_left = sprite.left - TILE_SIZE * 2
+        sprite.boundary_right = sprite.right + TILE_SIZE * 2
+        sprite_list.append(sprite)
+    return sprite_list
+
+
+def ladder_sprites(map_tiles: int, count: int) -> arcade.SpriteList:
+    """A SpriteList of ladders three tiles high, spread evenly over the map."""
+    sprite_list = arcade.SpriteList(use_spatial_hash=True)
+    spacing = map_tiles * TILE_SIZE / max(count // 3, 1)
+    for i in range(count):
+        sprite = arcade.Sprite(LADDER_TEXTURE, animate_characters.TILE_SCALING)
+        sprite.position = (i // 3 + 0.5) * spacing, TILE_SIZE * (i % 3 + 1.5)
+        sprite_list.append(sprite)
+    return sprite_list
+
+
+def animated_sprites(count: int) -> arcade.SpriteList:
+    """A SpriteList of coins that spin through frames of different lengths."""
+    textures = [arcade.load_texture(name) for name in (COIN_TEXTURE, COIN_FRAME_TEXTURE)]
+    sprite_list = arcade.SpriteList()
+    for i in range(count):
+        sprite = arcade.AnimatedTimeBasedSprite(scale=animate_characters.COIN_SCALING)
+        sprite.frames = [arcade.AnimationKeyframe(frame, 100 + i % 7 * 50, texture)
+                         for frame, texture in enumerate(textures)]
+        sprite.texture = textures[0]
+        sprite.position = i * TILE_SIZE, TILE_SIZE * 4
+        sprite_list.append(sprite)
+    return sprite_list
+
+
+def window_method(stage, name: str, **state):
+    """
+    Return a stage's MyGame method bound to just the state it reads.
+
+    The earlier stages keep their logic on the window, which needs a GL
+    context to make, so the method is bound to a plain object instead.
+    """
+    return types.MethodType(getattr(stage.MyGame, name), types.SimpleNamespace(**state))
+
+
+def bench_can_jump(stage, map_tiles: int):
+    """PhysicsEngine.can_jump with the key handler's 128 pixel probe."""
+    game = build_game(map_tiles, 0)
+    engine = stage.PhysicsEngine(game.player_sprite,
+                                 platforms=game.physics_engine.platforms,
+                                 walls=game.physics_engine.walls)
+    return lambda: engine.can_jump(128)
+
+
+def bench_coin_collision(stage, map_tiles: int, sprites: int):
+    """MyGame.player_coin_collision with no coin near the player."""
+    game = build_game(map_tiles, sprites)
+    game.player_sprite.center_y = TILE_SIZE * 10
+    if hasattr(stage, "Game"):
+        return types.MethodType(stage.Game.player_coin_collision, game)
+    return window_method(stage, "player_coin_collision", player_sprite=game.player_sprite,
+                         scene=game.scene, collect_coin_sound=game.collect_coin_sound,
+                         score=0)
+
+
+def bench_center_camera(stage):
+    """MyGame.center_camera_to_player."""
+    game = build_game(MAP_TILES[0], 0)
+    if hasattr(stage, "Game"):
+        return types.MethodType(stage.Game.center_camera_to_player, game)
+    return window_method(stage, "center_camera_to_player",
+                         player_sprite=game.player_sprite, camera=game.camera)
+
+
+def bench_update_animation(stage):
+    """Player.update_animation while walking."""
+    player = stage.Player()
+    player.change_x = animate_characters.PLAYER_MOVEMENT_SPEED
+    return player.update_animation
+
+
+def bench_scene_update(sprites: int):
+    """Scene.update over a layer of moving sprites."""
+    scene = arcade.Scene()
+    scene.add_sprite_list(animate_characters.LAYER_NAME_MOVING_PLATFORMS,
+                          sprite_list=moving_sprites(sprites))
+    return lambda: scene.update([animate_characters.LAYER_NAME_MOVING_PLATFORMS])
+
+
+def ladder_walk(engine_class, map_tiles: int, sprites: int):
+    """An engine's is_on_ladder as the player walks, so every call looks again."""
+    game = build_game(map_tiles, 0)
+    engine = engine_class(game.player_sprite, walls=game.physics_engine.walls,
+                          ladders=ladder_sprites(map_tiles, sprites))
+    player = game.player_sprite
+    start_x = player.center_x
+
+    def walk():
+        player.center_x = start_x if player.center_x > start_x + TILE_SIZE * 4 \
+            else player.center_x + 1
+        engine.is_on_ladder()
+    return walk
+
+
+def bench_is_on_ladder(stage, map_tiles: int, sprites: int):
+    """PhysicsEngine.is_on_ladder as the player walks."""
+    return ladder_walk(stage.PhysicsEngine, map_tiles, sprites)
+
+
+def bench_arcade_is_on_ladder(map_tiles: int, sprites: int):
+    """arcade's PhysicsEnginePlatformer.is_on_ladder as the player walks."""
+    return ladder_walk(arcade.PhysicsEnginePlatformer, map_tiles, sprites)
+
+
+def bench_move_platforms(stage, sprites: int):
+    """PhysicsEngine.move_platforms and Scene.update over a layer of moving sprites."""
+    game = build_game(MAP_TILES[0], 0)
+    scene = arcade.Scene()
+    scene.add_sprite_list(animate_characters.LAYER_NAME_MOVING_PLATFORMS,
+                          sprite_list=moving_sprites(sprites))
+    engine = stage.PhysicsEngine(game.player_sprite,
+                                 platforms=scene[animate_characters.LAYER_NAME_MOVING_PLATFORMS],
+                                 walls=game.physics_engine.walls)
+
+    def move():
+        engine.move_platforms()
+        scene.update([animate_characters.LAYER_NAME_MOVING_PLATFORMS])
+    return move
+
+
+def bench_platform_mover(stage, sprites: int):
+    """PlatformMover.update over a layer of moving sprites."""
+    mover = stage.PlatformMover(moving_sprites(sprites))
+    return mover.update
+
+
+def bench_scene_update_animation(sprites: int):
+    """Scene.update_animation over a layer of animated coins."""
+    scene = arcade.Scene()
+    scene.add_sprite_list(animate_characters.LAYER_NAME_COINS,
+                          sprite_list=animated_sprites(sprites))
+    return lambda: scene.update_animation(headless.FIXED_TIMESTEP,
+                                          [animate_characters.LAYER_NAME_COINS])
+
+
+def bench_tile_animator(stage, sprites: int):
+    """TileAnimator.update over a layer of animated coins."""
+    animator = stage.TileAnimator([animated_sprites(sprites)])
+    return lambda: animator.update(headless.FIXED_TIMESTEP)
+
+
+def bench_physics_update(stage, map_tiles: int, merge_walls: bool = False,
+                         continuous: bool = False):
+    """PhysicsEngine.update while walking right along the ground."""
+    game = build_game(map_tiles, 0)
+    engine = stage.PhysicsEngine(game.player_sprite,
+                                 platforms=game.physics_engine.platforms,
+                                 gravity_constant=animate_characters.GRAVITY,
+                                 walls=game.physics_engine.walls,
+                                 merge_walls=merge_walls,
+                                 continuous=continuous)
+    start_x = game.player_sprite.center_x
+
+    def walk():
+        # Walk back and forth without reaching the end walls
+        if game.player_sprite.center_x > start_x + TILE_SIZE * 4:
+            game.player_sprite.center_x = start_x
+        game.player_sprite.change_x = animate_characters.PLAYER_MOVEMENT_SPEED
+        engine.update()
+    return walk
+
+
+def bench_physics_update_merged(stage, map_tiles: int):
+    """PhysicsEngine.update against walls merged into boxes."""
+    return bench_physics_update(stage, map_tiles, merge_walls=True)
+
+
+def bench_physics_update_continuous(stage, map_tiles: int):
+    """PhysicsEngine.update against merged walls with swept falls."""
+    return bench_physics_update(stage, map_tiles, merge_walls=True, continuous=True)
+
+
+def bench_game_update(stage, map_tiles: int, sprites: int):
+    """A full Game.update tick while walking right."""
+    game = build_game(map_tiles, sprites)
+    game.right_pressed = True
+    return lambda: stage.Game.update(game, headless.FIXED_TIMESTEP)
+
+
+def bench_load_tilemap(map_name: str):
+    """arcade.load_tilemap of a bundled map, once its textures are cached."""
+    return lambda: arcade.load_tilemap(map_name, animate_characters.TILE_SCALING,
+                                       headless.HEADLESS_LAYER_OPTIONS)
+
+
+def bench_load_map(map_name: str):
+    """map_cache.load_map of a bundled map from its compiled cache."""
+    return lambda: map_cache.load_map(map_name, animate_characters.TILE_SCALING,
+                                      headless.HEADLESS_LAYER_OPTIONS)
+
+
+def bench_load_level(level: int):
+    """multiple_levels' parse and build of a level, once its textures are cached."""
+    return lambda: multiple_levels.build_level(multiple_levels.read_level_map(level))
+
+
+# The tutorial stages, in order
+STAGES = (
+    open_window,
+    draw_sprites,
+    user_control,
+    add_gravity,
+    scene_object,
+    camera,
+    add_coins_and_sound,
+    display_the_score,
+    load_a_map,
+    multiple_levels,
+    ladders_animated_moving_platforms,
+    animate_characters,
+)
+
+# (name, factory, Class.method a stage must define to be run, or None for
+# arcade's own code, uses map size, uses sprite count)
+BENCHMARKS = (
+    ("can_jump", bench_can_jump, "PhysicsEngine.can_jump", True, False),
+    ("player_coin_collision", bench_coin_collision,
+     "MyGame.player_coin_collision", True, True),
+    ("center_camera_to_player", bench_center_camera,
+     "MyGame.center_camera_to_player", False, False),
+    ("Player.update_animation", bench_update_animation,
+     "Player.update_animation", False, False),
+    ("PhysicsEngine.update", bench_physics_update, "PhysicsEngine.update", True, False),
+    ("PhysicsEngine.update(merge_walls)", bench_physics_update_merged,
+     "PhysicsEngine.update", True, False),
+    ("PhysicsEngine.update(continuous)", bench_physics_update_continuous,
+     "PhysicsEngine.update", True, False),
+    ("Scene.update", bench_scene_update, None, False, True),
+    ("PhysicsEnginePlatformer.is_on_ladder", bench_arcade_is_on_ladder, None, True, True),
+    ("PhysicsEngine.is_on_ladder", bench_is_on_ladder,
+     "PhysicsEngine.is_on_ladder", True, True),
+    ("PhysicsEngine.move_platforms+Scene.update", bench_move_platforms,
+     "PhysicsEngine.move_platforms", False, True),
+    ("PlatformMover.update", bench_platform_mover, "PlatformMover.update", False, True),
+    ("Scene.update_animation", bench_scene_update_animation, None, False, True),
+    ("TileAnimator.update", bench_tile_animator, "TileAnimator.update", False, True),
+    ("Game.update", bench_game_update, "Game.update", True, True),
+)
+
+
+def defines(stage, method: str) -> bool:
+    """Return True if a stage's own code, not arcade's, defines a Class.method."""
+    class_name, name = method.split(".")
+    function = getattr(getattr(stage, class_name, None), name, None)
+    # animate_characters keeps its helper classes in modules of their own
+    module = getattr(function, "__module__", None)
+    return module is not None and module.split(".")[0] not in ("arcade", "pyglet")
+
+
+def measure(func, min_time: float = 0.2, max_rounds: int = 100_000) -> dict:
+    """Call func repeatedly and return its timing statistics in microseconds."""
+    func()
+    timings = []
+    deadline = time.perf_counter() + min_time
+    while len(timings) < max_rounds and (len(timings) < 5 or time.perf_counter() < deadline):
+        start = time.perf_counter_ns()
+        func()
+        timings.append((time.perf_counter_ns() - start) / 1000)
+    timings.sort()
+    return {
+        "rounds": len(timings),
+        "min": timings[0],
+        "median": statistics.median(timings),
+        "mean": statistics.fmean(timings),
+        "p95": timings[int(len(timings) * 0.95) - 1] if len(timings) >= 20 else timings[-1],
+    }
+
+
+def run(quick: bool = False, min_time: float = 0.2) -> dict:
+    """Run every benchmark and return their statistics keyed by name."""
+    map_sizes = QUICK_MAP_TILES if quick else MAP_TILES
+    sprite_counts = QUICK_SPRITE_COUNTS if quick else SPRITE_COUNTS
+    results = {}
+
+    for name, factory, method, by_map, by_sprites in BENCHMARKS:
+        stages = [stage for stage in STAGES if defines(stage, method)] if method else [None]
+        for stage in stages:
+            for map_tiles in map_sizes if by_map else map_sizes[:1]:
+                for sprites in sprite_counts if by_sprites else sprite_counts[:1]:
+                    args = {} if stage is None else {"stage": stage}
+                    params = []
+                    if by_map:
+                        args["map_tiles"] = map_tiles
+                        params.append(f"tiles={map_tiles}")
+                    if by_sprites:
+                        args["sprites"] = sprites
+                        params.append(f"sprites={sprites}")
+                    label = f"{stage.__name__ if stage else 'arcade'}::{name}"
+                    if params:
+                        label += f"[{','.join(params)}]"
+                    results[label] = measure(factory(**args), min_time)
+
+    for map_name in MAP_NAMES if not quick else MAP_NAMES[:1]:
+        label = f"arcade::load_tilemap[{map_name.rsplit('/', 1)[-1]}]"
+        results[label] = measure(bench_load_tilemap(map_name), min_time, max_rounds=50)
+        label = f"animate_characters::load_map[{map_name.rsplit('/', 1)[-1]}]"
+        results[label] = measure(bench_load_map(map_name), min_time, max_rounds=50)
+
+    label = f"multiple_levels::build_level[{multiple_levels.level_map_name(1).rsplit('/', 1)[-1]}]"
+    results[label] = measure(bench_load_level(1), min_time, max_rounds=50)
+
+    return results
+
+
+def report(results: dict, baseline: dict = None):
+    """Print the results, with the change from a baseline if one is given."""
+    width = max(len(label) for label in results)
+    header = f"{'benchmark':<{width}}  {'median us':>11}  {'p95 us':>11}  {'rounds':>7}"
+    if baseline:
+        header += f"  {'change':>8}"
+    print(header)
+    for label, stats in results.items():
+        line = (f"{label:<{width}}  {stats['median']:>11.2f}  "
+                f"{stats['p95']:>11.2f}  {stats['rounds']:>7}")
+        if baseline and label in baseline:
+            change = stats["median"] / baseline[label]["median"] - 1
+            line += f"  {change:>+8.1%}"
+        print(line)
+
+
+def main():
+    """Main program code."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--quick", action="store_true",
+                        help="run the smaller sizes only")
+    parser.add_argument("--min-time", type=float, default=0.2,
+                        help="seconds to spend on each benchmark")
+    parser.add_argument("--save", help="write the results to a JSON file")
+    parser.add_argument("--compare", help="JSON results to compare against")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as baseline_file:
+            baseline = json.load(baseline_file)
+
+    results = run(args.quick, args.min_time)
+    report(results, baseline)
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as results_file:
+            json.dump(results, results_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
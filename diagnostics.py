@@ -0,0 +1,184 @@
+"""diagnostics.py - Frame rate, phase profiling and key recording of animate_characters.py."""
+
+import array
+import csv
+import json
+import math
+import os
+import struct
+import time
+
+# Written at the start of an input recording
+INPUT_MAGIC = b"PLTKEYS"
+
+# Magic, version, seconds per step and steps run, then (step, key, pressed)
+# per event. Keys are 64 bit, as pyglet gives an X11 key without a name as
+# its keycode << 32.
+INPUT_HEADER = struct.Struct("<7sHdI")
+INPUT_EVENT = struct.Struct("<IqB")
+INPUT_VERSION = 2
+
+
+class FPSCounter:
+    """A class to detect frames per second."""
+    def __init__(self, size: int = 60):
+        self.time = time.perf_counter()
+
+        # Ring buffer of the last frame times with a running total
+        self.size = size
+        self.frame_times = array.array("d", bytes(8 * size))
+        self.count = 0
+        self.index = 0
+        self.total_time = 0.0
+
+    def tick(self):
+        """Determine tick amount."""
+        t_1 = time.perf_counter()
+        dt = t_1 - self.time
+        self.time = t_1
+        self.total_time += dt - self.frame_times[self.index]
+        self.frame_times[self.index] = dt
+        self.index += 1
+        if self.index == self.size:
+            self.index = 0
+            # Re-sum once per lap so float error can't build up
+            self.total_time = sum(self.frame_times)
+        if self.count < self.size:
+            self.count += 1
+
+    def get_fps(self) -> float:
+        """Return FPS as a float."""
+        if self.total_time <= 0:
+            return 0
+        return self.count / self.total_time
+
+    def get_frame_time(self, percent: float) -> float:
+        """Return the frame time in seconds that percent of frames are within."""
+        if self.count == 0:
+            return 0
+        frame_times = sorted(self.frame_times[:self.count])
+        rank = math.ceil(percent / 100 * self.count) - 1
+        return frame_times[min(max(rank, 0), self.count - 1)]
+
+    def get_percentiles(self) -> tuple:
+        """Return the p50, p95 and p99 frame times in seconds."""
+        return (self.get_frame_time(50),
+                self.get_frame_time(95),
+                self.get_frame_time(99))
+
+    def get_worst_frame(self) -> float:
+        """Return the longest frame time in seconds."""
+        if self.count == 0:
+            return 0
+        return max(self.frame_times[:self.count])
+
+
+class FrameProfiler:
+    """A class to time each phase of a frame into ring buffers."""
+    def __init__(self, phases: tuple, size: int = 600):
+        self.enabled = False
+        self.phases = phases
+        self.size = size
+
+        # One ring buffer of nanoseconds per phase, indexed by frame slot
+        self.samples = [array.array("q", bytes(8 * size)) for _ in phases]
+        self.index = 0
+        self.count = 0
+        self.phase = 0
+        self.last = 0
+
+    def start(self):
+        """Start timing a frame."""
+        self.phase = 0
+        self.last = time.perf_counter_ns()
+
+    def mark(self):
+        """End the current phase and start the next one."""
+        now = time.perf_counter_ns()
+        self.samples[self.phase][self.index] = now - self.last
+        self.last = now
+        self.phase += 1
+
+    def finish(self):
+        """Finish timing a frame."""
+        self.index = (self.index + 1) % self.size
+        if self.count < self.size:
+            self.count += 1
+
+    def frames(self) -> list:
+        """Return each recorded frame's phase times in nanoseconds, oldest first."""
+        first = self.index - self.count
+        return [
+            [samples[(first + i) % self.size] for samples in self.samples]
+            for i in range(self.count)
+        ]
+
+    def summary(self) -> dict:
+        """Return the mean and worst time in microseconds of each phase."""
+        summary = {}
+        for phase, samples in zip(self.phases, self.samples):
+            recorded = samples[:self.count] if self.count < self.size else samples
+            summary[phase] = {
+                "mean_us": sum(recorded) / max(self.count, 1) / 1000,
+                "max_us": max(recorded, default=0) / 1000,
+            }
+        return summary
+
+    def dump(self, file_name: str):
+        """Write every recorded frame to a .csv file, or to JSON otherwise."""
+        frames = self.frames()
+        if file_name.endswith(".csv"):
+            with open(file_name, "w", newline="", encoding="utf-8") as dump_file:
+                writer = csv.writer(dump_file)
+                writer.writerow(["frame", *(f"{phase} ns" for phase in self.phases)])
+                for number, frame in enumerate(frames):
+                    writer.writerow([number, *frame])
+        else:
+            with open(file_name, "w", encoding="utf-8") as dump_file:
+                json.dump({
+                    "phases": list(self.phases),
+                    "unit": "ns",
+                    "frames": frames,
+                    "summary": self.summary(),
+                }, dump_file, indent=2)
+
+
+class InputRecording:
+    """A class to hold the keys pressed and released in each physics step."""
+    def __init__(self, timestep: float, events: list = (), ticks: int = 0):
+        self.timestep = timestep
+        self.events = list(events)
+
+        # Steps the session ran for, set before saving
+        self.ticks = ticks
+
+    def record(self, tick: int, button: int, pressed: bool):
+        """Add a key press or release made before the given step ran."""
+        self.events.append((tick, button, pressed))
+
+    def save(self, file_name: str):
+        """Write the events to a binary file."""
+        data = bytearray(INPUT_HEADER.pack(INPUT_MAGIC, INPUT_VERSION, self.timestep,
+                                           self.ticks))
+        for tick, button, pressed in self.events:
+            data += INPUT_EVENT.pack(tick, button, pressed)
+        temp_name = f"{file_name}.tmp"
+        with open(temp_name, "wb") as record_file:
+            record_file.write(data)
+        os.replace(temp_name, file_name)
+
+
+def load_input_recording(file_name: str) -> InputRecording:
+    """Read an InputRecording written by InputRecording.save."""
+    with open(file_name, "rb") as record_file:
+        data = record_file.read()
+    if len(data) < INPUT_HEADER.size:
+        raise ValueError(f"{file_name} is not an input recording.")
+    magic, version, timestep, ticks = INPUT_HEADER.unpack_from(data)
+    if magic != INPUT_MAGIC or version != INPUT_VERSION:
+        raise ValueError(f"{file_name} is not a version {INPUT_VERSION} input recording.")
+    if (len(data) - INPUT_HEADER.size) % INPUT_EVENT.size:
+        raise ValueError(f"{file_name} is cut short.")
+    events = [(tick, button, bool(pressed)) for tick, button, pressed
+              in INPUT_EVENT.iter_unpack(memoryview(data)[INPUT_HEADER.size:])]
+    return InputRecording(timestep, events, ticks)
@@ -1,7 +1,8 @@
 #! /usr/bin/env python3
 """camera.py - Adding a camera for bigger levels."""
 
-import collections
+import array
+import math
 import time
 
 import arcade
@@ -23,23 +24,57 @@ PLAYER_JUMP_SPEED = 20
 
 
 class FPSCounter:
-    def __init__(self):
+    """A class to detect frames per second."""
+    def __init__(self, size: int = 60):
         self.time = time.perf_counter()
-        self.frame_times = collections.deque(maxlen=60)
+
+        # Ring buffer of the last frame times with a running total
+        self.size = size
+        self.frame_times = array.array("d", bytes(8 * size))
+        self.count = 0
+        self.index = 0
+        self.total_time = 0.0
 
     def tick(self):
         """Determine tick amount."""
-        t1 = time.perf_counter()
-        dt = t1 - self.time
-        self.time = t1
-        self.frame_times.append(dt)
+        t_1 = time.perf_counter()
+        dt = t_1 - self.time
+        self.time = t_1
+        self.total_time += dt - self.frame_times[self.index]
+        self.frame_times[self.index] = dt
+        self.index += 1
+        if self.index == self.size:
+            self.index = 0
+            # Re-sum once per lap so float error can't build up
+            self.total_time = sum(self.frame_times)
+        if self.count < self.size:
+            self.count += 1
 
     def get_fps(self) -> float:
-        total_time = sum(self.frame_times)
-        if total_time == 0:
+        """Return FPS as a float."""
+        if self.total_time <= 0:
             return 0
-        else:
-            return len(self.frame_times) / sum(self.frame_times)
+        return self.count / self.total_time
+
+    def get_frame_time(self, percent: float) -> float:
+        """Return the frame time in seconds that percent of frames are within."""
+        if self.count == 0:
+            return 0
+        frame_times = sorted(self.frame_times[:self.count])
+        rank = math.ceil(percent / 100 * self.count) - 1
+        return frame_times[min(max(rank, 0), self.count - 1)]
+
+    def get_percentiles(self) -> tuple:
+        """Return the p50, p95 and p99 frame times in seconds."""
+        return (self.get_frame_time(50),
+                self.get_frame_time(95),
+                self.get_frame_time(99))
+
+    def get_worst_frame(self) -> float:
+        """Return the longest frame time in seconds."""
+        if self.count == 0:
+            return 0
+        return max(self.frame_times[:self.count])
 
 
 class Player(arcade.Sprite):
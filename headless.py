@@ -0,0 +1,283 @@
+#! /usr/bin/env python3
+"""headless.py - Run the game logic at a fixed timestep without a window."""
+
+import argparse
+import array
+import json
+import time
+
+from arcade import key
+from pyglet.math import Vec2
+
+import animate_characters as platformer
+from diagnostics import load_input_recording
+
+# Seconds of game time per tick
+FIXED_TIMESTEP = 1 / 60
+
+# Width of each bar of a tick time histogram, in microseconds
+HISTOGRAM_BUCKET_US = 50
+
+# Tick time percentiles reported and compared
+PERCENTILES = (50, 90, 99)
+
+# Collision checks against a SpriteList without a spatial hash run on the
+# GPU, so every layer gets one when there is no window.
+HEADLESS_LAYER_OPTIONS = {
+    name: {"use_spatial_hash": True}
+    for name in (
+        platformer.LAYER_NAME_MOVING_PLATFORMS,
+        platformer.LAYER_NAME_PLATFORMS,
+        platformer.LAYER_NAME_COINS,
+        platformer.LAYER_NAME_FOREGROUND,
+        platformer.LAYER_NAME_BACKGROUND,
+        platformer.LAYER_NAME_DONT_TOUCH,
+        platformer.LAYER_NAME_LADDERS,
+    )
+}
+
+
+class HeadlessCamera:
+    """A class that moves like arcade.Camera without needing a window."""
+    def __init__(self, viewport_width: int, viewport_height: int):
+        self.viewport_width = viewport_width
+        self.viewport_height = viewport_height
+        self.position = Vec2(0, 0)
+        self.goal_position = Vec2(0, 0)
+        self.move_speed = 1.0
+
+    def move_to(self, vector: Vec2, speed: float = 1.0):
+        """Sets the goal position of the camera."""
+        self.goal_position = Vec2(vector[0], vector[1])
+        self.move_speed = speed
+
+    def update(self):
+        """Move toward the goal position, as arcade.Camera.use does."""
+        self.position = self.position.lerp(self.goal_position, self.move_speed)
+
+
+class HeadlessGame(platformer.Game):
+    """The game logic with no window or GL context."""
+    def __init__(self):
+        super().__init__()
+        self.layer_options = HEADLESS_LAYER_OPTIONS
+
+    def setup(self):
+        """Set-up the game here. Call this function to restart the game."""
+        self.camera = HeadlessCamera(platformer.SCREEN_WIDTH, platformer.SCREEN_HEIGHT)
+        super().setup()
+
+
+class HeadlessRunner:
+    """A class to drive a game at a fixed timestep from scripted input."""
+    def __init__(self, game: platformer.Game, events: list,
+                 timestep: float = FIXED_TIMESTEP, timed: bool = False):
+        self.game = game
+        self.events = sorted(events, key=lambda event: event[0])
+        self.timestep = timestep
+        self.tick = 0
+        self.next_event = 0
+
+        # Nanoseconds each tick took, if timed
+        self.tick_times = array.array("q") if timed else None
+
+    def step(self):
+        """Feed this tick's input and run one update."""
+        if self.tick_times is not None:
+            start = time.perf_counter_ns()
+            self.run_tick()
+            self.tick_times.append(time.perf_counter_ns() - start)
+        else:
+            self.run_tick()
+
+    def run_tick(self):
+        """Feed this tick's input and run one update, untimed."""
+        events = self.events
+        while self.next_event < len(events) and events[self.next_event][0] <= self.tick:
+            _, button, pressed = events[self.next_event]
+            if pressed:
+                self.game.on_key_press(button, 0)
+            else:
+                self.game.on_key_release(button, 0)
+            self.next_event += 1
+
+        self.game.update(self.timestep)
+        self.game.camera.update()
+        self.tick += 1
+
+    def run(self, ticks: int) -> float:
+        """Run a number of ticks and return the ticks per second."""
+        start = time.perf_counter()
+        for _ in range(ticks):
+            self.step()
+        elapsed = time.perf_counter() - start
+        if elapsed == 0:
+            return 0
+        return ticks / elapsed
+
+
+def histogram(tick_times: array.array, bucket_us: int = HISTOGRAM_BUCKET_US) -> dict:
+    """Return tick time percentiles and counts per bucket, in microseconds."""
+    times = sorted(tick_times)
+    counts = {}
+    for tick_time in times:
+        bucket = int(tick_time / 1000 // bucket_us * bucket_us)
+        counts[bucket] = counts.get(bucket, 0) + 1
+    return {
+        "unit": "us",
+        "ticks": len(times),
+        "bucket_us": bucket_us,
+        "percentiles": {
+            f"p{percentile}": times[min(len(times) * percentile // 100, len(times) - 1)] / 1000
+            for percentile in PERCENTILES
+        } if times else {},
+        "max": times[-1] / 1000 if times else 0,
+        "counts": {str(bucket): count for bucket, count in counts.items()},
+    }
+
+
+def report_histogram(result: dict, baseline: dict = None):
+    """Print the tick time percentiles, with the change from a baseline if one is given."""
+    rows = [*result["percentiles"].items(), ("max", result["max"])]
+    for name, value in rows:
+        line = f"{name:>4}: {value:10.1f} us"
+        if baseline:
+            before = baseline["max"] if name == "max" else baseline["percentiles"].get(name)
+            if before:
+                line += f"  {value / before - 1:>+8.1%}"
+        print(line)
+
+    # One bar per bucket, scaled to the fullest
+    fullest = max(result["counts"].values(), default=0)
+    for bucket, count in result["counts"].items():
+        bar = "#" * max(1, round(count / fullest * 50))
+        print(f"{int(bucket):>8} us {count:>7} {bar}")
+
+
+def read_script(file_name: str) -> list:
+    """
+    Read (tick, key, pressed) input events from a text file.
+
+    Each line is a tick, an arcade key name and "press" or "release",
+    for example "30 RIGHT press". Blank lines and # comments are skipped.
+    """
+    events = []
+    with open(file_name, encoding="utf-8") as script:
+        for line in script:
+            line = line.split("#")[0].strip()
+            if not line:
+                continue
+            tick, name, action = line.split()
+            events.append((int(tick), getattr(key, name.upper()), action == "press"))
+    return events
+
+
+def demo_script(ticks: int) -> list:
+    """Hold right and jump every 45 ticks."""
+    events = [(0, key.RIGHT, True)]
+    for tick in range(10, ticks, 45):
+        events.append((tick, key.UP, True))
+        events.append((tick + 10, key.UP, False))
+    return events
+
+
+def check_physics(events: list, ticks: int, timestep: float) -> int:
+    """
+    Run the input with merged walls and with arcade's engine side by side.
+
+    :returns: The first tick the players part, or -1 if they never do
+    :rtype: int
+    """
+    runners = []
+    for merge_walls in (True, False):
+        game = HeadlessGame()
+        game.merge_walls = merge_walls
+        game.setup()
+        runners.append(HeadlessRunner(game, events, timestep))
+
+    merged, arcade_engine = (runner.game.player_sprite for runner in runners)
+    for tick in range(ticks):
+        for runner in runners:
+            runner.step()
+        if merged.position != arcade_engine.position:
+            print(f"Tick {tick}: merged walls at {merged.position}, "
+                  f"arcade's engine at {arcade_engine.position}")
+            return tick
+    return -1
+
+
+def main():
+    """Main program code."""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--ticks", type=int,
+                        help="number of fixed timesteps to run, 3600 or to the end of a replay")
+    parser.add_argument("--script",
+                        help="input script file, the demo input is used if not given")
+    parser.add_argument("--replay",
+                        help=f"input recorded by the game with {platformer.RECORD_ENV} set")
+    parser.add_argument("--timestep", type=float,
+                        help="seconds of game time per tick, the recorded one for a replay")
+    parser.add_argument("--stream", action="store_true",
+                        help="create the static tile layers only near the camera")
+    parser.add_argument("--profile",
+                        help="time each update phase and dump them to a .csv or .json file")
+    parser.add_argument("--histogram",
+                        help="write a histogram of tick times to a JSON file")
+    parser.add_argument("--compare-histogram",
+                        help="tick time histogram JSON to compare against")
+    parser.add_argument("--check-physics", action="store_true",
+                        help="check the player moves as with arcade's physics engine")
+    args = parser.parse_args()
+
+    timestep = args.timestep
+    ticks = args.ticks
+    if args.replay:
+        recording = load_input_recording(args.replay)
+        events = recording.events
+        timestep = timestep or recording.timestep
+        if ticks is None:
+            ticks = recording.ticks
+    else:
+        if ticks is None:
+            ticks = 3600
+        events = read_script(args.script) if args.script else demo_script(ticks)
+    timestep = timestep or FIXED_TIMESTEP
+
+    if args.check_physics:
+        if check_physics(events, ticks, timestep) >= 0:
+            raise SystemExit(1)
+        print(f"{ticks} ticks moved the player as arcade's physics engine does")
+        return
+
+    game = HeadlessGame()
+    if args.stream:
+        game.stream_layers = platformer.CHUNKED_LAYERS
+    game.setup()
+    game.profiler.enabled = bool(args.profile)
+    timed = bool(args.histogram or args.compare_histogram)
+    runner = HeadlessRunner(game, events, timestep, timed)
+    ticks_per_second = runner.run(ticks)
+
+    print(f"{ticks} ticks at {ticks_per_second:.0f} ticks per second")
+    print(f"Score: {game.score}, Lives: {game.lives_left}, "
+          f"Player: ({game.player_sprite.center_x:.0f}, {game.player_sprite.center_y:.0f})")
+
+    if args.profile:
+        for phase, times in game.profiler.summary().items():
+            print(f"{phase:>16}: {times['mean_us']:8.1f} us mean, {times['max_us']:8.1f} us max")
+        game.profiler.dump(args.profile)
+
+    if timed:
+        result = histogram(runner.tick_times)
+        baseline = None
+        if args.compare_histogram:
+            with open(args.compare_histogram, encoding="utf-8") as baseline_file:
+                baseline = json.load(baseline_file)
+        report_histogram(result, baseline)
+        if args.histogram:
+            with open(args.histogram, "w", encoding="utf-8") as histogram_file:
+                json.dump(result, histogram_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
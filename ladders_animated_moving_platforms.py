@@ -1,7 +1,9 @@
 #! /usr/bin/env python3
 """ladders_animated_moving_platforms.py - Add moving platforms and ladders."""
 
+import array
 import collections
+import math
 import os
 import time
 
@@ -38,8 +40,64 @@ LAYER_NAME_DONT_TOUCH = "Don't Touch"
 LAYER_NAME_LADDERS = "Ladders"
 
 
+# Axis-aligned box accepted by a SpriteList's spatial hash for broad-phase queries
+ProbeBox = collections.namedtuple("ProbeBox", ["left", "right", "bottom", "top"])
+
+
 class PhysicsEngine(arcade.PhysicsEnginePlatformer):
     """A slightly modified platformer physics engine."""
+    def probe(self, y_distance: float = 5, x_distance: float = 5) -> tuple:
+        """
+        Look for a floor below and walls to the left and right of the player.
+
+        One broad-phase query is made over the player box expanded by the probe
+        distances, and the hits are sorted by their edges instead of moving the
+        player and running a collision check for each direction.
+
+        :returns: (floor, left wall, right wall) contact flags
+        :rtype: tuple
+        """
+        player = self.player_sprite
+        left, right = player.left, player.right
+        bottom, top = player.bottom, player.top
+        area = ProbeBox(left - x_distance, right + x_distance,
+                        bottom - y_distance, top)
+
+        # Player hit box shifted once for each probe direction
+        hit_box = player.get_adjusted_hit_box()
+        below = [(x, y - y_distance) for x, y in hit_box]
+        to_left = [(x - x_distance, y) for x, y in hit_box]
+        to_right = [(x + x_distance, y) for x, y in hit_box]
+
+        floor = left_wall = right_wall = False
+        for sprite_lists in (self.walls, self.platforms):
+            for sprite_list in sprite_lists:
+                if sprite_list.spatial_hash:
+                    nearby = sprite_list.spatial_hash.get_objects_for_box(area)
+                else:
+                    nearby = sprite_list
+                for sprite in nearby:
+                    s_left, s_right = sprite.left, sprite.right
+                    s_bottom, s_top = sprite.bottom, sprite.top
+                    # Sort by edges first, then confirm with the hit box polygons
+                    if (not floor and s_left < right and s_right > left
+                            and s_top > bottom - y_distance
+                            and s_bottom < top - y_distance):
+                        floor = arcade.are_polygons_intersecting(
+                            below, sprite.get_adjusted_hit_box())
+                    if not s_top > bottom or not s_bottom < top:
+                        continue
+                    if (not left_wall and s_right > left - x_distance
+                            and s_left < right - x_distance):
+                        left_wall = arcade.are_polygons_intersecting(
+                            to_left, sprite.get_adjusted_hit_box())
+                    if (not right_wall and s_left < right + x_distance
+                            and s_right > left + x_distance):
+                        right_wall = arcade.are_polygons_intersecting(
+                            to_right, sprite.get_adjusted_hit_box())
+
+        return floor, left_wall, right_wall
+
     def can_jump(self, y_distance: float = 5, x_distance: float = 5) -> bool:
         """
         Method that looks to see if there is a floor under or if the player can wall jump.
@@ -47,67 +105,107 @@ class PhysicsEngine(arcade.PhysicsEnginePlatformer):
         :returns: True if there is a platform below us
         :rtype: bool
         """
-
-        # Move down to see if we are on a platform
-        self.player_sprite.center_y -= y_distance
-
-        # Check for wall hit
-        y_hit_list = arcade.check_for_collision_with_lists(
-            self.player_sprite, self.walls + self.platforms
-        )
-
-        self.player_sprite.center_y += y_distance
-
-        # Move left to see if we are next to a wall
-        self.player_sprite.center_x -= x_distance
-
-        # Check for left wall hit
-        left_hit_list = arcade.check_for_collision_with_lists(
-            self.player_sprite, self.walls + self.platforms
-        )
-
-        self.player_sprite.center_x += x_distance
-
-        # Move right to see if we are next to a wall
-        self.player_sprite.center_x += x_distance
-
-        # Check for left wall hit
-        right_hit_list = arcade.check_for_collision_with_lists(
-            self.player_sprite, self.walls + self.platforms
-        )
-
-        self.player_sprite.center_x -= x_distance
-
-        possible = (len(y_hit_list) > 0,
-                    len(left_hit_list) > 0,
-                    len(right_hit_list) > 0)
-
-        if True in possible:
-            print(possible)
-            return True
-        else:
-            return False
+        return True in self.probe(y_distance, x_distance)
 
 
 class FPSCounter:
     """A class to detect frames per second."""
-    def __init__(self):
+    def __init__(self, size: int = 60):
         self.time = time.perf_counter()
-        self.frame_times = collections.deque(maxlen=60)
+
+        # Ring buffer of the last frame times with a running total
+        self.size = size
+        self.frame_times = array.array("d", bytes(8 * size))
+        self.count = 0
+        self.index = 0
+        self.total_time = 0.0
 
     def tick(self):
         """Determine tick amount."""
         t_1 = time.perf_counter()
         dt = t_1 - self.time
         self.time = t_1
-        self.frame_times.append(dt)
+        self.total_time += dt - self.frame_times[self.index]
+        self.frame_times[self.index] = dt
+        self.index += 1
+        if self.index == self.size:
+            self.index = 0
+            # Re-sum once per lap so float error can't build up
+            self.total_time = sum(self.frame_times)
+        if self.count < self.size:
+            self.count += 1
 
     def get_fps(self) -> float:
         """Return FPS as a float."""
-        total_time = sum(self.frame_times)
-        if total_time == 0:
+        if self.total_time <= 0:
+            return 0
+        return self.count / self.total_time
+
+    def get_frame_time(self, percent: float) -> float:
+        """Return the frame time in seconds that percent of frames are within."""
+        if self.count == 0:
             return 0
-        return len(self.frame_times) / sum(self.frame_times)
+        frame_times = sorted(self.frame_times[:self.count])
+        rank = math.ceil(percent / 100 * self.count) - 1
+        return frame_times[min(max(rank, 0), self.count - 1)]
+
+    def get_percentiles(self) -> tuple:
+        """Return the p50, p95 and p99 frame times in seconds."""
+        return (self.get_frame_time(50),
+                self.get_frame_time(95),
+                self.get_frame_time(99))
+
+    def get_worst_frame(self) -> float:
+        """Return the longest frame time in seconds."""
+        if self.count == 0:
+            return 0
+        return max(self.frame_times[:self.count])
+
+
+class HUD:
+    """A class to keep one persistent text object per GUI label."""
+    def __init__(self):
+        self.labels = {}
+        self.values = {}
+
+        # Retained GUI shapes, drawn as a single batch
+        self.shapes = arcade.ShapeElementList()
+
+    def build_shapes(self, width: int, height: int):
+        """Build the GUI shapes for a window size."""
+        self.shapes = arcade.ShapeElementList()
+        self.shapes.append(arcade.create_rectangle_filled(
+            center_x=width / 14,
+            center_y=height - height / 10,
+            width=width / 7,
+            height=height / 4,
+            color=arcade.color.IRRESISTIBLE,
+        ))
+
+    def set_label(self, text: str, var: any, x: float, y: float):
+        """Set a label's value and place, only laying out its glyphs again on change."""
+        value = f"{text}: {var}"
+        label = self.labels.get(text)
+        if label is not None and label.position != (x, y):
+            label.position = x, y
+        if self.values.get(text) == value:
+            return
+        self.values[text] = value
+        if label is not None:
+            label.text = value
+        else:
+            self.labels[text] = arcade.Text(
+                text=value,
+                start_x=x, start_y=y,
+                color=arcade.csscolor.WHITE,
+                font_size=18,
+            )
+
+    def draw(self):
+        """Draw the shapes and every label."""
+        self.shapes.draw()
+        for label in self.labels.values():
+            label.draw()
 
 
 class Player(arcade.Sprite):
@@ -151,6 +249,7 @@ class MyGame(arcade.Window):
         self.lives_left = 0
         self.timer = 0
         self.fps = FPSCounter()
+        self.hud = HUD()
 
         # Keys are set as a tuple for easier access
         self.vertical = (key.UP, key.W, key.DOWN, key.S)
@@ -238,6 +337,20 @@ class MyGame(arcade.Window):
             walls=self.scene[LAYER_NAME_PLATFORMS]
         )
 
+        self.hud.build_shapes(self.width, self.height)
+        self.update_gui_info()
+
+    def on_resize(self, width: int, height: int):
+        """Fit the cameras and the GUI to the new window size."""
+        super().on_resize(width, height)
+        # pyglet can send this from Window.__init__, before the GUI exists
+        if getattr(self, "hud", None) is not None:
+            self.hud.build_shapes(width, height)
+        if getattr(self, "gui_camera", None) is not None:
+            self.camera.resize(width, height)
+            self.gui_camera.resize(width, height)
+            self.update_gui_info()
+
     @property
     def current_fps(self) -> float:
         """Determine current fps."""
@@ -248,39 +361,32 @@ class MyGame(arcade.Window):
         """Determine coins remaining."""
         return len(self.scene["Coins"])
 
-    @staticmethod
-    def gui_label(text: str, var: any, x: int, y: int):
+    def gui_label(self, text: str, var: any, x: int, y: int):
         """
-        Simplify arcade.draw_text.
+        Set a GUI label's text.
 
         Keyword arguments:
         text -- This is the label.
         var -- This is the variable value.
-        x -- This is the percent point of the screen's x x that it will start at.
-        y -- This is the percent point of the screen's y it will start at.
+        x -- This is the percent point of the GUI camera's x that it will start at.
+        y -- This is the percent point of the GUI camera's y it will start at.
         """
         x, y = x / 100, y / 100
-        arcade.draw_text(
-            text=f"{text}: {var}",
-            start_x=SCREEN_WIDTH * x, start_y=SCREEN_HEIGHT * y,
-            color=arcade.csscolor.WHITE,
-            font_size=18,
-        )
+        self.hud.set_label(text, var, self.gui_camera.viewport_width * x,
+                           self.gui_camera.viewport_height * y)
 
-    def display_gui_info(self):
-        """Display GUI information."""
-        arcade.draw_rectangle_filled(center_x=SCREEN_WIDTH / 14,
-                                     center_y=SCREEN_HEIGHT - SCREEN_HEIGHT / 10,
-                                     width=SCREEN_WIDTH / 7,
-                                     height=SCREEN_HEIGHT / 4,
-                                     color=arcade.color.IRRESISTIBLE,
-                                     )
+    def update_gui_info(self):
+        """Update GUI information."""
         self.gui_label("Score", self.score, 0, 95)
         self.gui_label("Coins Left", self.coins_left, 0, 90)
         self.gui_label("Time", round(self.timer), 0, 85)
         self.gui_label("Lives", self.lives_left, 0, 80)
         self.gui_label("FPS", round(self.current_fps), 90, 95)
 
+    def display_gui_info(self):
+        """Display GUI information."""
+        self.hud.draw()
+
     def on_draw(self):
         """Render the screen."""
         # Clears screen to the background color
@@ -431,6 +537,8 @@ class MyGame(arcade.Window):
         # Position the camera
         self.center_camera_to_player()
 
+        self.update_gui_info()
+
 
 def main():
     """Main program code."""
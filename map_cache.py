@@ -0,0 +1,524 @@
+"""map_cache.py - Load Tiled maps and texture hit boxes through a cache on disk."""
+
+import array
+import collections
+import hashlib
+import json
+import math
+import mmap
+import os
+import struct
+
+import arcade
+import pytiled_parser
+from arcade.resources import resolve_resource_path
+from arcade.sprite import AnimationKeyframe
+from arcade.tilemap.tilemap import TiledObject
+from arcade.tilemap.tilemap import (  # pylint: disable=protected-access
+    _get_image_info_from_tileset, _get_image_source)
+from pyglet.math import Vec2
+
+# Compiled maps and hit boxes are cached here, as the bundled maps live in
+# arcade's package
+CACHE_DIR = "cache"
+HIT_BOX_CACHE_FILE = os.path.join(CACHE_DIR, "hit_boxes.json")
+MAP_CACHE_MAGIC = b"PLTMAP"
+MAP_CACHE_VERSION = 1
+
+# Magic, format version, source mtime in ns, source SHA-1 and metadata length
+MAP_CACHE_HEADER = struct.Struct("<6sHq20sI")
+
+# Numbers kept for each sprite of an object layer, NaN for a boundary not set
+OBJECT_FIELDS = (
+    "gid", "width", "height", "center_x", "center_y", "angle", "change_x", "change_y",
+    "boundary_left", "boundary_right", "boundary_bottom", "boundary_top",
+)
+
+
+class HitBoxCache:
+    """A class to keep texture hit boxes on disk, keyed by image content and algorithm."""
+    def __init__(self, file_name: str):
+        self.file_name = file_name
+
+        # Points by key, read from the file on first use
+        self.points = None
+        self.changed = False
+
+    @staticmethod
+    def key(texture: arcade.Texture) -> str:
+        """Hash a texture's pixels together with how its hit box is calculated."""
+        image = texture.image
+        digest = hashlib.sha1(image.tobytes())
+        digest.update(f"{image.mode}{image.size}".encode())
+        # pylint: disable=protected-access
+        return f"{digest.hexdigest()}:{texture._hit_box_algorithm}:{texture._hit_box_detail}"
+
+    def fill(self, texture: arcade.Texture) -> tuple:
+        """Give a texture its hit box from the cache, calculating it only on a miss."""
+        # pylint: disable=protected-access
+        if texture._hit_box_points is not None:
+            return texture._hit_box_points
+
+        if self.points is None:
+            try:
+                with open(self.file_name, encoding="utf-8") as cache_file:
+                    self.points = json.load(cache_file)
+            except (OSError, ValueError):
+                self.points = {}
+
+        cache_key = self.key(texture)
+        if cache_key in self.points:
+            texture._hit_box_points = tuple(tuple(point) for point in self.points[cache_key])
+        else:
+            self.points[cache_key] = texture.hit_box_points
+            self.changed = True
+        return texture._hit_box_points
+
+    def save(self):
+        """Write the cache out if any hit box was calculated since it was read."""
+        if not self.changed:
+            return
+        temp_name = f"{self.file_name}.tmp"
+        try:
+            os.makedirs(os.path.dirname(self.file_name), exist_ok=True)
+            with open(temp_name, "w", encoding="utf-8") as cache_file:
+                json.dump(self.points, cache_file)
+            os.replace(temp_name, self.file_name)
+        except OSError:
+            # A read-only checkout calculates the hit boxes again next time
+            return
+        self.changed = False
+
+
+# Hit boxes shared by the map loaders and the player
+HIT_BOXES = HitBoxCache(HIT_BOX_CACHE_FILE)
+
+
+def tile_texture_args(tile: pytiled_parser.Tile, map_directory: str) -> list:
+    """The arguments arcade.TileMap loads a tile's texture with."""
+    image = str(_get_image_source(tile, map_directory))
+    if tile.animation:
+        return [image, 0, 0, 0, 0, False, False, False]
+    return [image, *_get_image_info_from_tileset(tile), tile.flipped_horizontally,
+            tile.flipped_vertically, tile.flipped_diagonally]
+
+
+def map_cache_path(source: str) -> str:
+    """Return where the compiled cache of a map file goes."""
+    name = os.path.splitext(os.path.basename(source))[0]
+    path_hash = hashlib.sha1(os.path.abspath(source).encode()).hexdigest()[:8]
+    return os.path.join(CACHE_DIR, f"{name}-{path_hash}.map")
+
+
+def normalize_options(layer_options: dict):
+    """Layer options as they read back from the cache's JSON."""
+    return json.loads(json.dumps(layer_options or {}, sort_keys=True, default=str))
+
+
+class MapCompiler:
+    """
+    A class to compile a Tiled map into the binary cache read by CompiledMap.
+
+    The file is a header, JSON metadata and 8 byte aligned typed arrays: the
+    GIDs of each tile layer, the numbers of each object sprite and the hit box
+    points of every tile used.
+    """
+    def __init__(self, map_name: str, scaling: float, layer_options: dict):
+        self.source = resolve_resource_path(map_name)
+        self.mtime_ns = os.stat(self.source).st_mtime_ns
+        with open(self.source, "rb") as source_file:
+            self.digest = hashlib.sha1(source_file.read()).digest()
+
+        self.tiled_map = pytiled_parser.parse_map(self.source)
+        self.scaling = scaling
+        self.layer_options = layer_options or {}
+
+        # A TileMap shell without layers makes the sprites exactly as arcade would
+        self.shell = arcade.TileMap.__new__(arcade.TileMap)
+        self.shell.tiled_map = self.tiled_map
+        self.shell.scaling = scaling
+        self.shell.width, self.shell.height = self.tiled_map.map_size
+        self.shell.tile_width, self.shell.tile_height = self.tiled_map.tile_size
+
+        self.arrays = []
+        self.data_size = 0
+        self.points = array.array("d")
+        self.meta = {
+            "scaling": scaling,
+            "layer_options": normalize_options(layer_options),
+            "map": {
+                "width": self.shell.width,
+                "height": self.shell.height,
+                "tile_width": self.shell.tile_width,
+                "tile_height": self.shell.tile_height,
+                "background_color": self.tiled_map.background_color,
+                "properties": self.tiled_map.properties,
+            },
+            "templates": {},
+            "layers": [],
+        }
+
+    @property
+    def compilable(self) -> bool:
+        """Only finite maps of tile and object layers are compiled."""
+        return not self.tiled_map.infinite and all(
+            isinstance(layer, (pytiled_parser.TileLayer, pytiled_parser.ObjectLayer))
+            for layer in self.tiled_map.layers)
+
+    def layer_settings(self, name: str) -> dict:
+        """The options arcade would load a layer with."""
+        settings = {
+            "scaling": self.scaling,
+            "use_spatial_hash": None,
+            "hit_box_algorithm": "Simple",
+            "hit_box_detail": 4.5,
+        }
+        for option in settings:
+            if option in self.layer_options.get(name, {}):
+                settings[option] = self.layer_options[name][option]
+        return settings
+
+    def add_array(self, values: array.array) -> dict:
+        """Queue an array for the data section and return where it will be."""
+        entry = {"offset": self.data_size, "typecode": values.typecode, "length": len(values)}
+        self.arrays.append(values)
+        size = len(values) * values.itemsize
+        self.data_size += size + -size % 8
+        return entry
+
+    def add_points(self, points) -> list:
+        """Add a hit box to the points array and return its [start, count]."""
+        start = len(self.points) // 2
+        for x, y in points:
+            self.points.extend((x, y))
+        return [start, len(points)]
+
+    def add_template(self, tile_gid: int, settings: dict):
+        """Record how to make the sprite of a tile, once for each GID."""
+        templates = self.meta["templates"]
+        if str(tile_gid) in templates:
+            return
+
+        shell = self.shell
+        map_directory = os.path.dirname(self.tiled_map.map_file)
+        # pylint: disable=protected-access
+        tile = shell._get_tile_by_gid(tile_gid)
+
+        # The texture gets its hit box from the cache before arcade makes the sprite
+        texture = tile_texture_args(tile, map_directory)
+        texture_hit_box = HIT_BOXES.fill(arcade.load_texture(
+            *texture,
+            hit_box_algorithm=settings["hit_box_algorithm"],
+            hit_box_detail=settings["hit_box_detail"],
+        ))
+        sprite = shell._create_sprite_from_tile(
+            tile,
+            scaling=settings["scaling"],
+            hit_box_algorithm=settings["hit_box_algorithm"],
+            hit_box_detail=settings["hit_box_detail"],
+        )
+
+        frames = None
+        if tile.animation:
+            frames = []
+            for frame in tile.animation:
+                frame_tile = shell._get_tile_by_id(tile.tileset, frame.tile_id)
+                frame_rect = [0, 0, 0, 0]
+                if not frame_tile.image:
+                    frame_rect = list(_get_image_info_from_tileset(frame_tile))
+                frames.append([frame.tile_id, frame.duration,
+                               str(_get_image_source(frame_tile, map_directory)), *frame_rect])
+
+        templates[str(tile_gid)] = {
+            "texture": texture,
+            "texture_hit_box": self.add_points(texture_hit_box),
+            "hit_box": self.add_points(sprite.get_hit_box()),
+            "frames": frames,
+            "properties": sprite.properties,
+        }
+
+    def compile_layer(self, layer: pytiled_parser.Layer) -> dict:
+        """Compile one layer into its metadata and arrays."""
+        settings = self.layer_settings(layer.name)
+        layer_meta = {
+            "name": layer.name,
+            "visible": layer.visible,
+            "tint_color": layer.tint_color,
+            "opacity": layer.opacity,
+            "properties": layer.properties,
+            **settings,
+        }
+
+        if isinstance(layer, pytiled_parser.TileLayer):
+            tile_gids = array.array("I")
+            for row in layer.data:
+                tile_gids.extend(row)
+            for tile_gid in sorted(set(tile_gids) - {0}):
+                self.add_template(tile_gid, settings)
+            layer_meta["tile_gids"] = self.add_array(tile_gids)
+            return layer_meta
+
+        # Object layers are processed by arcade, and its sprites read back
+        # pylint: disable=protected-access
+        sprite_list, objects = self.shell._process_object_layer(layer, **settings)
+        tile_objects = [tiled_object for tiled_object in layer.tiled_objects
+                        if isinstance(tiled_object, pytiled_parser.tiled_object.Tile)]
+        numbers = array.array("d")
+        sprite_properties = []
+        for tiled_object, sprite in zip(tile_objects, sprite_list or ()):
+            self.add_template(tiled_object.gid, settings)
+            values = [tiled_object.gid] + [getattr(sprite, field) for field in OBJECT_FIELDS[1:]]
+            numbers.extend(math.nan if value is None else value for value in values)
+            sprite_properties.append(sprite.properties)
+        layer_meta["sprites"] = self.add_array(numbers)
+        layer_meta["sprite_properties"] = sprite_properties
+        layer_meta["objects"] = [list(tiled_object) for tiled_object in objects or ()]
+        return layer_meta
+
+    def write(self, file_name: str):
+        """Compile every layer and write the cache file."""
+        for layer in self.tiled_map.layers:
+            self.meta["layers"].append(self.compile_layer(layer))
+        self.meta["points"] = self.add_array(self.points)
+
+        meta = json.dumps(self.meta, default=str).encode()
+        header = MAP_CACHE_HEADER.pack(MAP_CACHE_MAGIC, MAP_CACHE_VERSION,
+                                       self.mtime_ns, self.digest, len(meta))
+
+        # Written aside and moved into place, so a reader never sees half a file
+        os.makedirs(os.path.dirname(file_name), exist_ok=True)
+        temp_name = f"{file_name}.tmp"
+        with open(temp_name, "wb") as cache_file:
+            cache_file.write(header)
+            cache_file.write(meta)
+            cache_file.write(bytes(-(len(header) + len(meta)) % 8))
+            for values in self.arrays:
+                data = values.tobytes()
+                cache_file.write(data)
+                cache_file.write(bytes(-len(data) % 8))
+        os.replace(temp_name, file_name)
+
+
+class CompiledTileMap(arcade.TileMap):
+    """
+    A TileMap built from a compiled map file.
+
+    The Tiled map is only parsed from the source if something asks for it,
+    such as get_tilemap_layer.
+    """
+    def __init__(self, source: str):  # pylint: disable=super-init-not-called
+        # arcade's __init__ parses the map and makes every sprite, which the
+        # compiled map is there to avoid. CompiledMap.build sets the rest.
+        self.source = source
+        self.parsed_map = None
+
+    @property
+    def tiled_map(self) -> pytiled_parser.TiledMap:
+        """The Tiled map the compiled map was made from, parsed on first use."""
+        if self.parsed_map is None:
+            self.parsed_map = pytiled_parser.parse_map(self.source)
+        return self.parsed_map
+
+
+class CompiledMap:
+    """A class to build a TileMap from a compiled map file, memory-mapped."""
+    def __init__(self, file_name: str):
+        with open(file_name, "rb") as cache_file:
+            self.buffer = mmap.mmap(cache_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            magic, version, self.mtime_ns, self.digest, meta_size = \
+                MAP_CACHE_HEADER.unpack_from(self.buffer)
+            if magic != MAP_CACHE_MAGIC or version != MAP_CACHE_VERSION:
+                raise ValueError(
+                    f"{file_name} is not a version {MAP_CACHE_VERSION} compiled map.")
+
+            meta_end = MAP_CACHE_HEADER.size + meta_size
+            self.meta = json.loads(self.buffer[MAP_CACHE_HEADER.size:meta_end])
+        except (ValueError, struct.error):
+            self.close()
+            raise
+        self.data_start = meta_end + -meta_end % 8
+
+        # Hit boxes made so far, shared by every sprite of a tile
+        self.hit_boxes = {}
+
+    def close(self):
+        """Unmap the file, so it can be replaced. Nothing can be built after this."""
+        self.buffer.close()
+
+    def is_current(self, source: str, scaling: float, layer_options: dict) -> bool:
+        """Return True if this was compiled from the source as it is now."""
+        if self.meta["scaling"] != scaling:
+            return False
+        if self.meta["layer_options"] != normalize_options(layer_options):
+            return False
+        if os.stat(source).st_mtime_ns == self.mtime_ns:
+            return True
+        with open(source, "rb") as source_file:
+            return hashlib.sha1(source_file.read()).digest() == self.digest
+
+    def array(self, entry: dict) -> memoryview:
+        """Return a typed view of an array in the file, without copying it."""
+        start = self.data_start + entry["offset"]
+        size = entry["length"] * array.array(entry["typecode"]).itemsize
+        return memoryview(self.buffer)[start:start + size].cast(entry["typecode"])
+
+    def hit_box(self, entry: list) -> tuple:
+        """Return the hit box at a [start, count] of the points array."""
+        start, count = entry
+        if (start, count) not in self.hit_boxes:
+            points = self.array(self.meta["points"])
+            self.hit_boxes[start, count] = tuple(
+                (points[i], points[i + 1]) for i in range(start * 2, (start + count) * 2, 2))
+        return self.hit_boxes[start, count]
+
+    def make_sprite(self, tile_gid: int, layer: dict) -> arcade.Sprite:
+        """Make the sprite of a tile, with no hit box calculated."""
+        template = self.meta["templates"][str(tile_gid)]
+
+        # The texture's hit box is filled in before anything asks for it
+        texture = arcade.load_texture(*template["texture"],
+                                      hit_box_algorithm=layer["hit_box_algorithm"],
+                                      hit_box_detail=layer["hit_box_detail"])
+        # pylint: disable=protected-access
+        if texture._hit_box_points is None:
+            texture._hit_box_points = self.hit_box(template["texture_hit_box"])
+
+        if template["frames"]:
+            sprite = arcade.AnimatedTimeBasedSprite(template["texture"][0], layer["scaling"])
+            sprite.frames = [
+                AnimationKeyframe(tile_id, duration, arcade.load_texture(image, *rect))
+                for tile_id, duration, image, *rect in template["frames"]
+            ]
+            sprite.texture = sprite.frames[0].texture
+        else:
+            sprite = arcade.Sprite(texture=texture, scale=layer["scaling"])
+
+        sprite.hit_box = self.hit_box(template["hit_box"])
+        sprite.properties = dict(template["properties"])
+        return sprite
+
+    def build(self, source: str) -> arcade.TileMap:
+        """
+        Build a TileMap with the sprites arcade.load_tilemap would have made.
+
+        source is the map file this was compiled from, parsed only if the
+        TileMap's tiled_map is asked for.
+        """
+        map_meta = self.meta["map"]
+        tile_map = CompiledTileMap(source)
+        tile_map.width = map_meta["width"]
+        tile_map.height = map_meta["height"]
+        tile_map.tile_width = map_meta["tile_width"]
+        tile_map.tile_height = map_meta["tile_height"]
+        tile_map.background_color = map_meta["background_color"] and tuple(
+            map_meta["background_color"])
+        tile_map.properties = map_meta["properties"]
+        tile_map.scaling = self.meta["scaling"]
+        # The map-wide settings arcade.load_tilemap leaves at their defaults
+        tile_map.use_spatial_hash = None
+        tile_map.hit_box_algorithm = "Simple"
+        tile_map.hit_box_detail = 4.5
+        tile_map.offset = Vec2(0, 0)
+        tile_map.sprite_lists = collections.OrderedDict()
+        tile_map.object_lists = collections.OrderedDict()
+
+        for layer in self.meta["layers"]:
+            sprite_list = arcade.SpriteList(use_spatial_hash=layer["use_spatial_hash"])
+            sprite_list.visible = layer["visible"]
+            if layer["properties"]:
+                sprite_list.properties = layer["properties"]
+
+            if "tile_gids" in layer:
+                self.build_tile_layer(layer, sprite_list)
+                tile_map.sprite_lists[layer["name"]] = sprite_list
+                continue
+
+            self.build_object_layer(layer, sprite_list)
+            if sprite_list:
+                tile_map.sprite_lists[layer["name"]] = sprite_list
+            if layer["objects"]:
+                tile_map.object_lists[layer["name"]] = [
+                    TiledObject(*tiled_object) for tiled_object in layer["objects"]]
+
+        return tile_map
+
+    def build_tile_layer(self, layer: dict, sprite_list: arcade.SpriteList):
+        """Fill a SpriteList with the tiles of a tile layer."""
+        map_meta = self.meta["map"]
+        columns, rows = map_meta["width"], map_meta["height"]
+        tile_width = map_meta["tile_width"] * layer["scaling"]
+        tile_height = map_meta["tile_height"] * layer["scaling"]
+
+        for index, tile_gid in enumerate(self.array(layer["tile_gids"])):
+            if tile_gid == 0:
+                continue
+            row, column = divmod(index, columns)
+            sprite = self.make_sprite(tile_gid, layer)
+            sprite.center_x = column * tile_width + sprite.width / 2
+            sprite.center_y = (rows - row - 1) * tile_height + sprite.height / 2
+            if layer["tint_color"]:
+                sprite.color = layer["tint_color"]
+            if layer["opacity"]:
+                sprite.alpha = int(layer["opacity"] * 255)
+            sprite_list.append(sprite)
+
+    def build_object_layer(self, layer: dict, sprite_list: arcade.SpriteList):
+        """Fill a SpriteList with the tile objects of an object layer."""
+        numbers = self.array(layer["sprites"])
+        fields = len(OBJECT_FIELDS)
+        for index, properties in enumerate(layer["sprite_properties"]):
+            values = dict(zip(OBJECT_FIELDS, numbers[index * fields:(index + 1) * fields]))
+            sprite = self.make_sprite(int(values["gid"]), layer)
+            sprite.width = values["width"]
+            sprite.height = values["height"]
+            sprite.position = values["center_x"], values["center_y"]
+            sprite.angle = values["angle"]
+            if layer["tint_color"]:
+                sprite.color = layer["tint_color"]
+            if layer["opacity"]:
+                sprite.alpha = int(layer["opacity"] * 255)
+            for field in OBJECT_FIELDS[6:]:
+                if not math.isnan(values[field]):
+                    setattr(sprite, field, values[field])
+            sprite.properties = properties
+            sprite_list.append(sprite)
+
+
+def load_map(map_name: str, scaling: float, layer_options: dict) -> arcade.TileMap:
+    """
+    Load a Tiled map through its compiled cache.
+
+    The map is compiled on first use and again whenever its source changes.
+    A map that can't be compiled or cached is loaded by arcade as usual.
+    """
+    source = resolve_resource_path(map_name)
+    cache_file = map_cache_path(source)
+    try:
+        compiled = CompiledMap(cache_file)
+    except (OSError, ValueError, struct.error):
+        pass
+    else:
+        # A stale file is unmapped before the new one replaces it
+        try:
+            if compiled.is_current(source, scaling, layer_options):
+                return compiled.build(source)
+        except OSError:
+            pass
+        finally:
+            compiled.close()
+
+    compiler = MapCompiler(map_name, scaling, layer_options)
+    if not compiler.compilable:
+        return arcade.load_tilemap(map_name, scaling, layer_options)
+    try:
+        compiler.write(cache_file)
+        compiled = CompiledMap(cache_file)
+    except OSError:
+        # Without a cache it can write, arcade loads the map as usual
+        return arcade.load_tilemap(map_name, scaling, layer_options)
+    try:
+        return compiled.build(source)
+    finally:
+        compiled.close()
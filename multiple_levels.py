@@ -1,11 +1,15 @@
 #! /usr/bin/env python3
 """camera.py - Adding a camera for bigger levels."""
 
-import collections
+import array
+import concurrent.futures
+import math
 import time
 
 import arcade
+import pytiled_parser
 from arcade import key
+from arcade.resources import resolve_resource_path
 
 # Constraints
 SCREEN_WIDTH = 1000
@@ -34,26 +38,344 @@ LAYER_NAME_FOREGROUND = "Foreground"
 LAYER_NAME_BACKGROUND = "Background"
 LAYER_NAME_DONT_TOUCH = "Don't Touch"
 
+# Layer specific options are defined on Layer names in a dictionary
+# Doing this will make the SpriteList for the platforms layer
+# use spatial hashing for detection.
+LAYER_OPTIONS = {
+    LAYER_NAME_PLATFORMS: {
+        "use_spatial_hash": True,
+    },
+    LAYER_NAME_COINS: {
+        "use_spatial_hash": True,
+    },
+    LAYER_NAME_DONT_TOUCH: {
+        "use_spatial_hash": True,
+    },
+}
+
+# Cells across each tile of the hazard grid, so the inside of a hazard that
+# doesn't fill its tile is still answered without a polygon test
+HAZARD_CELLS_PER_TILE = 4
+
+
+def hit_box_bounds(sprite: arcade.Sprite) -> tuple:
+    """Return the (left, right, bottom, top) of a sprite's hit box in one pass."""
+    points = sprite.get_adjusted_hit_box()
+    if not points:
+        return sprite.center_x, sprite.center_x, sprite.center_y, sprite.center_y
+    x_points, y_points = zip(*points)
+    return min(x_points), max(x_points), min(y_points), max(y_points)
+
+
+def level_map_name(level: int) -> str:
+    """Name of the map file for a level."""
+    return f":resources:tiled_maps/map2_level_{level}.json"
+
+
+def read_level_map(level: int) -> pytiled_parser.TiledMap:
+    """
+    Parse a level's map and decode every tile image it uses.
+
+    Only Sprites and Textures are made here, never SpriteLists, so no GL
+    objects are touched and it is safe to run off the main thread.
+    """
+    tiled_map = pytiled_parser.parse_map(resolve_resource_path(level_map_name(level)))
+
+    # A TileMap shell without layers lets arcade load the tiles exactly as it
+    # will later, which leaves their textures and hit boxes in its cache.
+    shell = arcade.TileMap.__new__(arcade.TileMap)
+    shell.tiled_map = tiled_map
+    tile_gids = set()
+    for layer in tiled_map.layers:
+        if isinstance(layer, pytiled_parser.TileLayer) and layer.data:
+            for row in layer.data:
+                tile_gids.update(row)
+    tile_gids.discard(0)
+    for tile_gid in tile_gids:
+        tile = shell._get_tile_by_gid(tile_gid)  # pylint: disable=protected-access
+        if tile:
+            shell._create_sprite_from_tile(tile, scaling=TILE_SCALING)  # pylint: disable=protected-access
+
+    return tiled_map
+
+
+def build_level(tiled_map: pytiled_parser.TiledMap) -> tuple:
+    """Build the TileMap and Scene for a parsed map. Call from the main thread."""
+    tile_map = arcade.TileMap(tiled_map=tiled_map, scaling=TILE_SCALING,
+                              layer_options=LAYER_OPTIONS)
+
+    # Initialize Scene
+    # Automatically adds all layers as SpriteLists in proper order.
+    scene = arcade.Scene.from_tilemap(tile_map)
+
+    # Adding sprite list after means that the foreground will be rendered
+    # after the Player, meaning it will appear to be in front or over the top.
+    # Doing this before add_sprite means the draw order is possible, otherwise
+    # it is not possible to do.
+    scene.add_sprite_list_after("Player", LAYER_NAME_FOREGROUND)
+    return tile_map, scene
+
 
 class FPSCounter:
     """A class to detect frames per second."""
-    def __init__(self):
+    def __init__(self, size: int = 60):
         self.time = time.perf_counter()
-        self.frame_times = collections.deque(maxlen=60)
+
+        # Ring buffer of the last frame times with a running total
+        self.size = size
+        self.frame_times = array.array("d", bytes(8 * size))
+        self.count = 0
+        self.index = 0
+        self.total_time = 0.0
 
     def tick(self):
         """Determine tick amount."""
         t_1 = time.perf_counter()
         dt = t_1 - self.time
         self.time = t_1
-        self.frame_times.append(dt)
+        self.total_time += dt - self.frame_times[self.index]
+        self.frame_times[self.index] = dt
+        self.index += 1
+        if self.index == self.size:
+            self.index = 0
+            # Re-sum once per lap so float error can't build up
+            self.total_time = sum(self.frame_times)
+        if self.count < self.size:
+            self.count += 1
 
     def get_fps(self) -> float:
         """Return FPS as a float."""
-        total_time = sum(self.frame_times)
-        if total_time == 0:
+        if self.total_time <= 0:
+            return 0
+        return self.count / self.total_time
+
+    def get_frame_time(self, percent: float) -> float:
+        """Return the frame time in seconds that percent of frames are within."""
+        if self.count == 0:
+            return 0
+        frame_times = sorted(self.frame_times[:self.count])
+        rank = math.ceil(percent / 100 * self.count) - 1
+        return frame_times[min(max(rank, 0), self.count - 1)]
+
+    def get_percentiles(self) -> tuple:
+        """Return the p50, p95 and p99 frame times in seconds."""
+        return (self.get_frame_time(50),
+                self.get_frame_time(95),
+                self.get_frame_time(99))
+
+    def get_worst_frame(self) -> float:
+        """Return the longest frame time in seconds."""
+        if self.count == 0:
             return 0
-        return len(self.frame_times) / sum(self.frame_times)
+        return max(self.frame_times[:self.count])
+
+
+class HUD:
+    """A class to keep one persistent text object per GUI label."""
+    def __init__(self):
+        self.labels = {}
+        self.values = {}
+
+        # Retained GUI shapes, drawn as a single batch
+        self.shapes = arcade.ShapeElementList()
+
+    def build_shapes(self, width: int, height: int):
+        """Build the GUI shapes for a window size."""
+        self.shapes = arcade.ShapeElementList()
+        self.shapes.append(arcade.create_rectangle_filled(
+            center_x=width / 14,
+            center_y=height - height / 10,
+            width=width / 7,
+            height=height / 4,
+            color=arcade.color.IRRESISTIBLE,
+        ))
+
+    def set_label(self, text: str, var: any, x: float, y: float):
+        """Set a label's value and place, only laying out its glyphs again on change."""
+        value = f"{text}: {var}"
+        label = self.labels.get(text)
+        if label is not None and label.position != (x, y):
+            label.position = x, y
+        if self.values.get(text) == value:
+            return
+        self.values[text] = value
+        if label is not None:
+            label.text = value
+        else:
+            self.labels[text] = arcade.Text(
+                text=value,
+                start_x=x, start_y=y,
+                color=arcade.csscolor.WHITE,
+                font_size=18,
+            )
+
+    def draw(self):
+        """Draw the shapes and every label."""
+        self.shapes.draw()
+        for label in self.labels.values():
+            label.draw()
+
+
+class LevelCache:
+    """A class to load upcoming levels while the current one is played."""
+    def __init__(self):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self.parsing = {}
+        self.levels = {}
+
+    def preload(self, level: int):
+        """Start parsing a level in the background."""
+        if level not in self.parsing and level not in self.levels:
+            self.parsing[level] = self.executor.submit(read_level_map, level)
+
+    def update(self):
+        """Build one parsed level into a ready Scene. Call from the main thread."""
+        for level, future in self.parsing.items():
+            if future.done():
+                del self.parsing[level]
+                # Failures are raised again if the level is asked for
+                if future.exception() is None:
+                    self.levels[level] = build_level(future.result())
+                return
+
+    def get(self, level: int) -> tuple:
+        """Return the (TileMap, Scene) for a level, loading it now if needed."""
+        if level in self.levels:
+            return self.levels.pop(level)
+        future = self.parsing.pop(level, None)
+        if future is not None and future.exception() is None:
+            return build_level(future.result())
+        return build_level(read_level_map(level))
+
+
+def hit_box_span(points, left: float, right: float) -> tuple:
+    """Return the lowest and highest y of a convex hit box between two x values."""
+    y_points = []
+    for (x1, y1), (x2, y2) in zip(points, (*points[1:], points[0])):
+        if left <= x1 <= right:
+            y_points.append(y1)
+        for x in (left, right):
+            if min(x1, x2) < x < max(x1, x2):
+                y_points.append(y1 + (y2 - y1) * (x - x1) / (x2 - x1))
+    return min(y_points), max(y_points)
+
+
+def crosses_box(start: tuple, end: tuple, left: float, right: float,
+                bottom: float, top: float) -> bool:
+    """Return True if a line segment passes through the inside of a box."""
+    (x1, y1), (x2, y2) = start, end
+    enter, leave = 0.0, 1.0
+    for towards, room in ((x1 - x2, x1 - left), (x2 - x1, right - x1),
+                          (y1 - y2, y1 - bottom), (y2 - y1, top - y1)):
+        if towards == 0:
+            if room <= 0:
+                return False
+        elif towards < 0:
+            enter = max(enter, room / towards)
+        else:
+            leave = min(leave, room / towards)
+    return enter < leave
+
+
+def covers_box(points, left: float, right: float, bottom: float, top: float) -> bool:
+    """Return True if a hit box holds the whole of a box."""
+    # A box edge lying along the hit box's edge still counts as inside
+    left, right, bottom, top = left + 1e-6, right - 1e-6, bottom + 1e-6, top - 1e-6
+    if not all(arcade.is_point_in_polygon(x, y, points)
+               for x, y in ((left, bottom), (right, bottom), (right, top), (left, top))):
+        return False
+    return not any(crosses_box(start, end, left, right, bottom, top)
+                   for start, end in zip(points, (*points[1:], points[0])))
+
+
+class HazardGrid:
+    """
+    A class to rasterize a static hazard layer into a grid of cells.
+
+    Cells a hazard's hit box covers whole are hits as soon as the player's
+    hit box reaches into them. Only cells at the edge of a hazard keep the
+    hazards for a polygon test.
+    """
+    EMPTY, EDGE, COVERED = range(3)
+
+    def __init__(self, hazards: arcade.SpriteList, width: int, height: int,
+                 cell_size: float = GRID_PIXEL_SIZE / HAZARD_CELLS_PER_TILE):
+        self.width = width
+        self.height = height
+        self.cell_size = cell_size
+
+        # One byte per cell, EMPTY, EDGE or COVERED
+        self.cells = bytearray(width * height)
+
+        # Hazards in each edge cell, for the exact polygon test
+        self.hazards = {}
+
+        for hazard in hazards:
+            points = hazard.get_adjusted_hit_box()
+            for cell, box in self.cells_for_box(*hit_box_bounds(hazard)):
+                if self.cells[cell] == self.COVERED:
+                    continue
+                if covers_box(points, *box):
+                    self.cells[cell] = self.COVERED
+                    self.hazards.pop(cell, None)
+                else:
+                    self.cells[cell] = self.EDGE
+                    self.hazards.setdefault(cell, []).append(hazard)
+
+    def cells_for_box(self, left: float, right: float, bottom: float, top: float):
+        """Yield the index and (left, right, bottom, top) of every cell a box overlaps."""
+        size = self.cell_size
+        first_column = max(int(left // size), 0)
+        last_column = min(int(right // size), self.width - 1)
+        first_row = max(int(bottom // size), 0)
+        last_row = min(int(top // size), self.height - 1)
+        for row in range(first_row, last_row + 1):
+            row_start = row * self.width
+            for column in range(first_column, last_column + 1):
+                yield row_start + column, (column * size, (column + 1) * size,
+                                           row * size, (row + 1) * size)
+
+    def touching(self, sprite: arcade.Sprite) -> bool:
+        """Return True if a sprite touches a hazard."""
+        left, right, bottom, top = hit_box_bounds(sprite)
+        size = self.cell_size
+        cells = self.cells
+        first_column = max(int(left // size), 0)
+        last_column = min(int(right // size), self.width - 1)
+        covered = []
+        edge_hazards = []
+        for row in range(max(int(bottom // size), 0), min(int(top // size), self.height - 1) + 1):
+            row_start = row * self.width
+            if not any(cells[row_start + first_column:row_start + last_column + 1]):
+                continue
+            for column in range(first_column, last_column + 1):
+                cell = cells[row_start + column]
+                if cell == self.COVERED:
+                    covered.append((row, column))
+                elif cell == self.EDGE:
+                    edge_hazards.extend(self.hazards[row_start + column])
+
+        # A covered cell is a hit if the hit box itself, not just its
+        # bounds, reaches into it
+        hit_box = sprite.get_adjusted_hit_box()
+        spans = {}
+        for row, column in covered:
+            if column not in spans:
+                strip_left = max(column * size, left)
+                strip_right = min((column + 1) * size, right)
+                spans[column] = hit_box_span(hit_box, strip_left, strip_right) \
+                    if strip_left < strip_right else None
+            span = spans[column]
+            if span and row * size < span[1] and (row + 1) * size > span[0]:
+                return True
+
+        checked = set()
+        for hazard in edge_hazards:
+            if hazard not in checked:
+                checked.add(hazard)
+                if arcade.check_for_collision(sprite, hazard):
+                    return True
+        return False
 
 
 class Player(arcade.Sprite):
@@ -93,6 +415,7 @@ class MyGame(arcade.Window):
         self.lives_left = 0
         self.timer = 0
         self.fps = FPSCounter()
+        self.hud = HUD()
 
         # Keys are set as a tuple for easier access
         self.up = (key.UP, key.W)
@@ -107,6 +430,10 @@ class MyGame(arcade.Window):
         self.end_of_map = 0
 
         self.level = 1
+        self.level_cache = LevelCache()
+
+        # Grid of the Don't Touch tiles of the current level
+        self.hazard_grid = None
 
         # Load sounds
         self.collect_coin_sound = arcade.load_sound(":resources:sounds/coin1.wav")
@@ -122,55 +449,38 @@ class MyGame(arcade.Window):
         self.camera = arcade.Camera(self.width, self.height)
         self.gui_camera = arcade.Camera(self.width, self.height)
 
-        # Name of map file to load
-        map_name = f":resources:tiled_maps/map2_level_{self.level}.json"
-
-        # Layer specific options are defined on Layer names in a dictionary
-        # Doing this will make the SpriteList for the platforms layer
-        # use spatial hashing for detection.
-        layer_options = {
-            LAYER_NAME_PLATFORMS: {
-                "use_spatial_hash": True,
-            },
-            LAYER_NAME_COINS: {
-                "use_spatial_hash": True,
-            },
-            LAYER_NAME_DONT_TOUCH: {
-                "use_spatial_hash": True,
-             },
-        }
-
-        # Read in tiled map
-        self.tile_map = arcade.load_tilemap(map_name, TILE_SCALING, layer_options)
-
-        # Initialize Scene
-        # Automatically adds all layers as SpriteLists in proper order.
-        self.scene = arcade.Scene.from_tilemap(self.tile_map)
-
-        # Player setup
-        # Adding sprite list after means that the foreground will be rendered
-        # after the Player, meaning it will appear to be in front or over the top.
-        # Doing this before add_sprite means the draw order is possible, otherwise
-        # it is not possible to do.
-        self.scene.add_sprite_list_after("Player", LAYER_NAME_FOREGROUND)
-
         image_source = ":resources:images" \
                        "/animated_characters/female_adventurer" \
                        "/femaleAdventurer_idle.png"
         self.player_sprite = Player(image_source, CHARACTER_SCALING)
-        self.player_sprite.center_x = PLAYER_START_X
-        self.player_sprite.center_y = PLAYER_START_Y
+
+        self.start_level()
+
+        self.hud.build_shapes(self.width, self.height)
+        self.update_gui_info()
+
+    def start_level(self):
+        """Swap in the current level's Scene, keeping the player and Cameras."""
+        self.tile_map, self.scene = self.level_cache.get(self.level)
+
+        # Player setup
+        self.player_sprite.remove_from_sprite_lists()
+        self.stop_player()
+        self.reset_player()
         self.scene.add_sprite("Player", self.player_sprite)
 
-        # Create the physics engine
-        self.physics_engine = arcade.PhysicsEnginePlatformer(
-            self.player_sprite, gravity_constant=GRAVITY, walls=self.scene["Platforms"]
-        )
+        # Each level starts with the camera at the map's origin
+        self.camera.move_to((0, 0), 1)
 
         # Set up game information for GUI
         self.score = 0
         self.lives_left = 5
 
+        # Create the physics engine
+        self.physics_engine = arcade.PhysicsEnginePlatformer(
+            self.player_sprite, gravity_constant=GRAVITY, walls=self.scene["Platforms"]
+        )
+
         # --- Other stuff
         # Set the background color
         if self.tile_map.background_color:
@@ -179,6 +489,25 @@ class MyGame(arcade.Window):
         # Calculate the right edge of the my_map in pixels
         self.end_of_map = self.tile_map.width * GRID_PIXEL_SIZE
 
+        # Hazards are static tiles, so they are rasterized once per level
+        self.hazard_grid = HazardGrid(self.scene[LAYER_NAME_DONT_TOUCH],
+                                      self.tile_map.width * HAZARD_CELLS_PER_TILE,
+                                      self.tile_map.height * HAZARD_CELLS_PER_TILE)
+
+        # Get the next level ready while this one is played
+        self.level_cache.preload(self.level + 1)
+
+    def on_resize(self, width: int, height: int):
+        """Fit the cameras and the GUI to the new window size."""
+        super().on_resize(width, height)
+        # pyglet can send this from Window.__init__, before the GUI exists
+        if getattr(self, "hud", None) is not None:
+            self.hud.build_shapes(width, height)
+        if getattr(self, "gui_camera", None) is not None:
+            self.camera.resize(width, height)
+            self.gui_camera.resize(width, height)
+            self.update_gui_info()
+
     @property
     def current_fps(self) -> float:
         """Determine current fps."""
@@ -189,39 +518,32 @@ class MyGame(arcade.Window):
         """Determine coins remaining."""
         return len(self.scene["Coins"])
 
-    @staticmethod
-    def gui_label(text: str, var: any, x: int, y: int):
+    def gui_label(self, text: str, var: any, x: int, y: int):
         """
-        Simplify arcade.draw_text.
+        Set a GUI label's text.
 
         Keyword arguments:
         text -- This is the label.
         var -- This is the variable value.
-        x -- This is the percent point of the screen's x x that it will start at.
-        y -- This is the percent point of the screen's y it will start at.
+        x -- This is the percent point of the GUI camera's x that it will start at.
+        y -- This is the percent point of the GUI camera's y it will start at.
         """
         x, y = x / 100, y / 100
-        arcade.draw_text(
-            text=f"{text}: {var}",
-            start_x=SCREEN_WIDTH * x, start_y=SCREEN_HEIGHT * y,
-            color=arcade.csscolor.WHITE,
-            font_size=18,
-        )
+        self.hud.set_label(text, var, self.gui_camera.viewport_width * x,
+                           self.gui_camera.viewport_height * y)
 
-    def display_gui_info(self):
-        """Display GUI information."""
-        arcade.draw_rectangle_filled(center_x=SCREEN_WIDTH / 14,
-                                     center_y=SCREEN_HEIGHT - SCREEN_HEIGHT / 10,
-                                     width=SCREEN_WIDTH / 7,
-                                     height=SCREEN_HEIGHT / 4,
-                                     color=arcade.color.IRRESISTIBLE,
-                                     )
+    def update_gui_info(self):
+        """Update GUI information."""
         self.gui_label("Score", self.score, 0, 95)
         self.gui_label("Coins Left", self.coins_left, 0, 90)
         self.gui_label("Time", round(self.timer), 0, 85)
         self.gui_label("Lives", self.lives_left, 0, 80)
         self.gui_label("FPS", round(self.current_fps), 90, 95)
 
+    def display_gui_info(self):
+        """Display GUI information."""
+        self.hud.draw()
+
     def on_draw(self):
         """Render the screen."""
         # Clears screen to the background color
@@ -324,9 +646,7 @@ class MyGame(arcade.Window):
 
     def touched_dont_touch(self):
         """Detect collision on Don't Touch layer. Reset player if collision."""
-        if arcade.check_for_collision_with_list(
-            self.player_sprite, self.scene[LAYER_NAME_DONT_TOUCH]
-        ):
+        if self.hazard_grid.touching(self.player_sprite):
             self.game_over()
 
     def at_end_of_level(self):
@@ -334,8 +654,8 @@ class MyGame(arcade.Window):
         if self.player_sprite.center_x >= self.end_of_map:
             self.level += 1
 
-            # Load the next level
-            self.setup()
+            # Swap in the next level
+            self.start_level()
 
     def on_update(self, delta_time: float):
         """Movement and game logic."""
@@ -354,6 +674,9 @@ class MyGame(arcade.Window):
         # Position the camera
         self.center_camera_to_player()
 
+        self.update_gui_info()
+        self.level_cache.update()
+
 
 def main():
     """Main program code."""
@@ -0,0 +1,547 @@
+"""physics.py - Collision lookups and the physics engine of animate_characters.py."""
+
+import bisect
+import collections
+import math
+
+import arcade
+from arcade.sprite_list.spatial_hash import _check_for_collision  # pylint: disable=protected-access
+
+# Pixel size of a tile in the stages' maps, which are loaded at half scale
+TILE_SIZE = 128 * 0.5
+
+
+def hit_box_bounds(sprite: arcade.Sprite) -> tuple:
+    """Return the (left, right, bottom, top) of a sprite's hit box in one pass."""
+    points = sprite.get_adjusted_hit_box()
+    if not points:
+        return sprite.center_x, sprite.center_x, sprite.center_y, sprite.center_y
+    x_points, y_points = zip(*points)
+    return min(x_points), max(x_points), min(y_points), max(y_points)
+
+
+def hit_box_span(points, left: float, right: float) -> tuple:
+    """Return the lowest and highest y of a convex hit box between two x values."""
+    y_points = []
+    for (x1, y1), (x2, y2) in zip(points, (*points[1:], points[0])):
+        if left <= x1 <= right:
+            y_points.append(y1)
+        for x in (left, right):
+            if min(x1, x2) < x < max(x1, x2):
+                y_points.append(y1 + (y2 - y1) * (x - x1) / (x2 - x1))
+    return min(y_points), max(y_points)
+
+
+# Axis-aligned box accepted by a SpriteList's spatial hash for broad-phase queries
+ProbeBox = collections.namedtuple("ProbeBox", ["left", "right", "bottom", "top"])
+
+# Boxes that overlap by less than this many pixels are only touching
+CONTACT_TOLERANCE = 0.01
+
+
+class CollisionGroup:
+    """
+    A class to check sprites against several SpriteLists as one group.
+
+    Lists with a spatial hash are queried through it and the rest are walked
+    on the CPU, where arcade.check_for_collision_with_lists would hand them
+    to the GPU.
+    """
+    def __init__(self, sprite_lists: list = ()):
+        self.sprite_lists = []
+        self.replace(sprite_lists)
+
+    def replace(self, sprite_lists: list):
+        """Check against these SpriteLists from now on."""
+        self.sprite_lists[:] = sprite_lists
+
+    def __iter__(self):
+        return iter(self.sprite_lists)
+
+    def __len__(self) -> int:
+        return len(self.sprite_lists)
+
+    def nearby(self, box):
+        """Yield the sprites in the group that may overlap a box or sprite."""
+        for sprite_list in self.sprite_lists:
+            if sprite_list.spatial_hash:
+                yield from sprite_list.spatial_hash.get_objects_for_box(box)
+            else:
+                yield from sprite_list
+
+    def collisions(self, sprite: arcade.Sprite) -> list:
+        """Return the sprites in the group that overlap a sprite."""
+        return [other for other in self.nearby(sprite)
+                if other is not sprite and _check_for_collision(sprite, other)]
+
+    def colliding(self, sprite: arcade.Sprite) -> bool:
+        """Return True if any sprite in the group overlaps a sprite."""
+        for other in self.nearby(sprite):
+            if other is not sprite and _check_for_collision(sprite, other):
+                return True
+        return False
+
+
+class StaticRects:
+    """A class to merge static rectangular tiles into run-length boxes."""
+    def __init__(self, sprite_lists: list, cell_size: float = TILE_SIZE):
+        self.cell_size = cell_size
+
+        # Tiles whose hit box is not a rectangle, such as ramps
+        self.others = arcade.SpriteList(use_spatial_hash=True)
+
+        # Horizontal spans of rectangular tiles, keyed by their bottom and top
+        rows = collections.defaultdict(list)
+        for sprite_list in sprite_lists:
+            for sprite in sprite_list:
+                left, right, bottom, top = hit_box_bounds(sprite)
+                points = sprite.get_adjusted_hit_box()
+                if len(points) == 4 and all(
+                        x in (left, right) and y in (bottom, top) for x, y in points):
+                    rows[round(bottom, 2), round(top, 2)].append((left, right))
+                else:
+                    self.others.append(sprite)
+
+        # Tiles in a row that touch are merged into one box
+        self.rects = []
+        for (bottom, top), spans in rows.items():
+            spans.sort()
+            left, right = spans[0]
+            for span_left, span_right in spans[1:]:
+                if span_left <= right + CONTACT_TOLERANCE:
+                    right = max(right, span_right)
+                else:
+                    self.rects.append(ProbeBox(left, right, bottom, top))
+                    left, right = span_left, span_right
+            self.rects.append(ProbeBox(left, right, bottom, top))
+
+        # Boxes by the grid columns they cross
+        self.columns = collections.defaultdict(list)
+        for rect in self.rects:
+            for column in range(int(rect.left // cell_size), int(rect.right // cell_size) + 1):
+                self.columns[column].append(rect)
+
+    def overlapping(self, left: float, right: float, bottom: float, top: float,
+                    hit_box: tuple = None) -> list:
+        """
+        Return the boxes that overlap a box, not counting boxes that only touch it.
+
+        With hit_box, the bounds of a hit box, only the boxes the hit box
+        itself overlaps are returned.
+        """
+        size = self.cell_size
+        hits = []
+        for column in range(int(left // size), int(right // size) + 1):
+            for rect in self.columns.get(column, ()):
+                if (rect.left >= right - CONTACT_TOLERANCE
+                        or rect.right <= left + CONTACT_TOLERANCE or rect in hits):
+                    continue
+                low, high = bottom, top
+                if hit_box is not None:
+                    low, high = hit_box_span(hit_box, max(rect.left, left),
+                                             min(rect.right, right))
+                if (rect.bottom < high - CONTACT_TOLERANCE
+                        and rect.top > low + CONTACT_TOLERANCE):
+                    hits.append(rect)
+        return hits
+
+    def swept(self, left: float, right: float, bottom: float, top: float,
+              change_y: float, hit_box: tuple = None) -> list:
+        """
+        Return the boxes met by a box that has just moved change_y.
+
+        These are the boxes overlapping where it ended up, as with overlapping,
+        and those it passed through on the way.
+        """
+        size = self.cell_size
+        hits = []
+        for column in range(int(left // size), int(right // size) + 1):
+            for rect in self.columns.get(column, ()):
+                if (rect.left >= right - CONTACT_TOLERANCE
+                        or rect.right <= left + CONTACT_TOLERANCE or rect in hits):
+                    continue
+                low, high = bottom, top
+                if hit_box is not None:
+                    low, high = hit_box_span(hit_box, max(rect.left, left),
+                                             min(rect.right, right))
+                if change_y < 0:
+                    met = (rect.top > low + CONTACT_TOLERANCE
+                           and (rect.bottom < high - CONTACT_TOLERANCE
+                                or rect.top <= low - change_y + CONTACT_TOLERANCE))
+                else:
+                    met = (rect.bottom < high - CONTACT_TOLERANCE
+                           and (rect.top > low + CONTACT_TOLERANCE
+                                or rect.bottom >= high - change_y - CONTACT_TOLERANCE))
+                if met:
+                    hits.append(rect)
+        return hits
+
+
+class LadderColumns:
+    """A class to merge ladder tiles into vertical runs, sorted by column."""
+    def __init__(self, sprite_lists: list):
+        # Ladders whose hit box is not a rectangle
+        self.others = arcade.SpriteList(use_spatial_hash=True)
+
+        # Vertical spans of rectangular tiles, keyed by their left and right
+        columns = collections.defaultdict(list)
+        for sprite_list in sprite_lists:
+            for sprite in sprite_list:
+                left, right, bottom, top = hit_box_bounds(sprite)
+                points = sprite.get_adjusted_hit_box()
+                if len(points) == 4 and all(
+                        x in (left, right) and y in (bottom, top) for x, y in points):
+                    columns[round(left, 2), round(right, 2)].append((bottom, top))
+                else:
+                    self.others.append(sprite)
+
+        # Columns sorted by left edge, each with its runs sorted by bottom.
+        # Tiles in a column that touch are merged into one run.
+        self.lefts, self.rights = [], []
+        self.bottoms, self.tops = [], []
+        self.widest = 0
+        for (left, right), spans in sorted(columns.items()):
+            spans.sort()
+            bottoms, tops = [], []
+            bottom, top = spans[0]
+            for span_bottom, span_top in spans[1:]:
+                if span_bottom <= top + CONTACT_TOLERANCE:
+                    top = max(top, span_top)
+                else:
+                    bottoms.append(bottom)
+                    tops.append(top)
+                    bottom, top = span_bottom, span_top
+            bottoms.append(bottom)
+            tops.append(top)
+
+            self.lefts.append(left)
+            self.rights.append(right)
+            self.bottoms.append(bottoms)
+            self.tops.append(tops)
+            self.widest = max(self.widest, right - left)
+
+    def touching(self, sprite: arcade.Sprite) -> bool:
+        """Return True if a sprite's hit box overlaps a ladder."""
+        left, right, bottom, top = hit_box_bounds(sprite)
+        hit_box = sprite.get_adjusted_hit_box()
+
+        # Walk back from the last column starting left of the sprite's right
+        # edge until no column is wide enough to reach its left edge
+        column = bisect.bisect_left(self.lefts, right)
+        while column:
+            column -= 1
+            column_left = self.lefts[column]
+            if column_left <= left - self.widest:
+                break
+            column_right = self.rights[column]
+            if column_right <= left:
+                continue
+
+            bottoms, tops = self.bottoms[column], self.tops[column]
+            run = bisect.bisect_left(bottoms, top)
+            while run and tops[run - 1] > bottom:
+                run -= 1
+                run_bottom, run_top = bottoms[run], tops[run]
+                if arcade.are_polygons_intersecting(hit_box, (
+                        (column_left, run_bottom), (column_right, run_bottom),
+                        (column_right, run_top), (column_left, run_top))):
+                    return True
+
+        if self.others:
+            return bool(arcade.check_for_collision_with_list(sprite, self.others))
+        return False
+
+
+class PhysicsEngine(arcade.PhysicsEnginePlatformer):
+    """A slightly modified platformer physics engine."""
+    def __init__(self, *args, merge_walls: bool = False, moving_platforms: bool = True,
+                 continuous: bool = False, **kwargs):
+        """
+        Create a physics engine for a platformer.
+
+        With merge_walls the walls must be static. Their rectangular tiles are
+        merged into boxes the player is moved against with box math alone.
+        With merge_walls and without moving_platforms, update leaves the
+        platforms for the caller to move, such as with a PlatformMover.
+        With merge_walls and continuous, falls and jumps stop at the first
+        merged box in the player's path, however far the player moves in a
+        tick, instead of only at boxes the player ends up in. continuous
+        without merge_walls raises a ValueError.
+        """
+        if continuous and not merge_walls:
+            raise ValueError("continuous collision needs merge_walls.")
+        super().__init__(*args, **kwargs)
+        self.moving_platforms = moving_platforms
+        self.continuous = continuous
+        self.static_rects = None
+
+        # Every wall and platform for the probes, and those the player is
+        # moved against with polygon checks
+        self.obstacles = CollisionGroup()
+        self.solid_lists = CollisionGroup()
+        if merge_walls:
+            self.build_static_rects()
+        else:
+            self.update_groups()
+
+        # Ladder contact, kept until the player's adjusted hit box is rebuilt
+        self.ladder_columns = None
+        self.ladder_hit_box = None
+        self.on_ladder = False
+        self.build_ladder_columns()
+
+    def build_static_rects(self):
+        """Merge the walls into boxes. Call again whenever the walls change."""
+        self.static_rects = StaticRects(self.walls)
+        self.update_groups()
+
+    def update_groups(self):
+        """Refill the collision groups. Call again after replacing walls or platforms."""
+        self.obstacles.replace(self.walls + self.platforms)
+        if self.static_rects is None:
+            self.solid_lists.replace(self.walls + self.platforms)
+        elif self.static_rects.others:
+            self.solid_lists.replace([self.static_rects.others] + self.platforms)
+        else:
+            self.solid_lists.replace(self.platforms)
+
+    def build_ladder_columns(self):
+        """Merge the ladders into columns. Call again whenever the ladders change."""
+        self.ladder_columns = LadderColumns(self.ladders or [])
+        self.ladder_hit_box = None
+
+    def is_on_ladder(self) -> bool:
+        """Return True if the player is in contact with a ladder."""
+        # Moving the player drops its adjusted hit box, so while the same
+        # list comes back the player has not moved and the answer stands
+        hit_box = self.player_sprite.get_adjusted_hit_box()
+        if hit_box is not self.ladder_hit_box:
+            self.ladder_hit_box = hit_box
+            self.on_ladder = self.ladder_columns.touching(self.player_sprite)
+        return self.on_ladder
+
+    def probe(self, y_distance: float = 5, x_distance: float = 5) -> tuple:
+        """
+        Look for a floor below and walls to the left and right of the player.
+
+        One broad-phase query is made over the player box expanded by the probe
+        distances, and the hits are sorted by their edges instead of moving the
+        player and running a collision check for each direction.
+
+        :returns: (floor, left wall, right wall) contact flags
+        :rtype: tuple
+        """
+        player = self.player_sprite
+        left, right = player.left, player.right
+        bottom, top = player.bottom, player.top
+        area = ProbeBox(left - x_distance, right + x_distance,
+                        bottom - y_distance, top)
+
+        # Player hit box shifted once for each probe direction
+        hit_box = player.get_adjusted_hit_box()
+        below = [(x, y - y_distance) for x, y in hit_box]
+        to_left = [(x - x_distance, y) for x, y in hit_box]
+        to_right = [(x + x_distance, y) for x, y in hit_box]
+
+        floor = left_wall = right_wall = False
+        for sprite in self.obstacles.nearby(area):
+            s_left, s_right = sprite.left, sprite.right
+            s_bottom, s_top = sprite.bottom, sprite.top
+            # Sort by edges first, then confirm with the hit box polygons
+            if (not floor and s_left < right and s_right > left
+                    and s_top > bottom - y_distance
+                    and s_bottom < top - y_distance):
+                floor = arcade.are_polygons_intersecting(
+                    below, sprite.get_adjusted_hit_box())
+            if not s_top > bottom or not s_bottom < top:
+                continue
+            if (not left_wall and s_right > left - x_distance
+                    and s_left < right - x_distance):
+                left_wall = arcade.are_polygons_intersecting(
+                    to_left, sprite.get_adjusted_hit_box())
+            if (not right_wall and s_left < right + x_distance
+                    and s_right > left + x_distance):
+                right_wall = arcade.are_polygons_intersecting(
+                    to_right, sprite.get_adjusted_hit_box())
+
+        return floor, left_wall, right_wall
+
+    def can_jump(self, y_distance: float = 5, x_distance: float = 5) -> bool:
+        """
+        Method that looks to see if there is a floor under or if the player can wall jump.
+
+        :returns: True if there is a platform below us
+        :rtype: bool
+        """
+        return True in self.probe(y_distance, x_distance)
+
+    def touching(self, hit_list: list = None) -> bool:
+        """
+        Return True if the player overlaps a wall or platform.
+
+        Sprites hit that were not merged into boxes are added to hit_list.
+        """
+        player = self.player_sprite
+        if self.static_rects.overlapping(*hit_box_bounds(player),
+                                         player.get_adjusted_hit_box()):
+            return True
+        hits = self.solid_lists.collisions(player)
+        if hit_list is not None:
+            for sprite in hits:
+                if sprite not in hit_list:
+                    hit_list.append(sprite)
+        return len(hits) > 0
+
+    def move_player(self) -> list:
+        """
+        Move the player and resolve collisions as arcade's engine does.
+
+        Merged boxes are checked against the player's hit box polygon, as
+        arcade checks the tiles. A fall or jump into them moves the player
+        out in the same steps arcade's engine takes, at once.
+        Ramps and moving platforms keep the polygon checks.
+
+        :returns: Sprites hit that were not merged into boxes
+        :rtype: list
+        """
+        player = self.player_sprite
+        solid_lists = self.solid_lists
+        original_y = player.center_y
+
+        # --- Move in the y direction
+        player.center_y += player.change_y
+        left, right, bottom, top = hit_box_bounds(player)
+        hit_box = player.get_adjusted_hit_box()
+        if self.continuous and player.change_y:
+            rect_hits = self.static_rects.swept(left, right, bottom, top,
+                                                player.change_y, hit_box)
+        else:
+            rect_hits = self.static_rects.overlapping(left, right, bottom, top, hit_box)
+        if rect_hits:
+            # How far the hit box is into the boxes, where it is over them.
+            # Arcade steps out 1 pixel at a time going up and 0.25 going down.
+            spans = [hit_box_span(hit_box, max(rect.left, left), min(rect.right, right))
+                     for rect in rect_hits]
+            if player.change_y > 0:
+                depth = max(high - rect.bottom for rect, (_, high) in zip(rect_hits, spans))
+                player.center_y -= math.ceil(depth - CONTACT_TOLERANCE)
+            elif player.change_y < 0:
+                depth = max(rect.top - low for rect, (low, _) in zip(rect_hits, spans))
+                player.center_y += math.ceil(depth * 4 - CONTACT_TOLERANCE) / 4
+
+        hit_list = solid_lists.collisions(player)
+        if hit_list:
+            if player.change_y > 0:
+                while solid_lists.colliding(player):
+                    player.center_y -= 1
+            elif player.change_y < 0:
+                for item in hit_list:
+                    while arcade.check_for_collision(player, item):
+                        player.center_y += 0.25
+                    if item.change_x != 0:
+                        player.center_x += item.change_x
+
+        if hit_list:
+            player.change_y = min(0.0, hit_list[0].change_y)
+        elif rect_hits:
+            player.change_y = 0.0
+        player.center_y = round(player.center_y, 2)
+
+        # --- Move in the x direction
+        # The height is kept between tries and a ramp is tried from the
+        # height before the y move, as in arcade's engine
+        if player.change_x:
+            original_x = player.center_x
+            almost_original_y = player.center_y
+            direction = math.copysign(1, player.change_x)
+            lower_bound, upper_bound = 0, abs(player.change_x)
+            x_change, y_change = upper_bound, 0
+
+            # Search for the furthest move that does not collide
+            while True:
+                player.center_x = original_x + x_change * direction
+                colliding = self.touching(hit_list)
+                if colliding:
+                    # Walk up a ramp if lifting by the move clears it
+                    y_change = x_change
+                    player.center_y = original_y + y_change
+                    colliding = self.touching()
+                    if colliding:
+                        y_change = 0
+                    else:
+                        while not colliding and y_change > 0:
+                            y_change -= 1
+                            player.center_y = almost_original_y + y_change
+                            colliding = self.touching()
+                        y_change += 1
+                        break
+                    upper_bound = x_change - 1
+                    if upper_bound - lower_bound <= 0:
+                        x_change = lower_bound
+                        break
+                    x_change = (upper_bound + lower_bound) // 2
+                else:
+                    lower_bound = x_change
+                    if upper_bound - lower_bound <= 0:
+                        break
+                    x_change = (upper_bound + lower_bound) // 2 + (upper_bound + lower_bound) % 2
+
+            player.center_x = original_x + x_change * direction
+            player.center_y = almost_original_y + y_change
+
+        return hit_list
+
+    def move_platforms(self):
+        """Move the moving platforms, turning them around at their boundaries."""
+        for platform_list in self.platforms:
+            for platform in platform_list:
+                if platform.change_x != 0 or platform.change_y != 0:
+
+                    # Check x boundaries and move the platform in x direction
+                    if platform.boundary_left and platform.left <= platform.boundary_left:
+                        platform.left = platform.boundary_left
+                        if platform.change_x < 0:
+                            platform.change_x *= -1
+
+                    if platform.boundary_right and platform.right >= platform.boundary_right:
+                        platform.right = platform.boundary_right
+                        if platform.change_x > 0:
+                            platform.change_x *= -1
+
+                    platform.center_x += platform.change_x
+
+                    # Check y boundaries and move the platform in y direction
+                    if platform.boundary_top is not None \
+                            and platform.top >= platform.boundary_top:
+                        platform.top = platform.boundary_top
+                        if platform.change_y > 0:
+                            platform.change_y *= -1
+
+                    if platform.boundary_bottom is not None \
+                            and platform.bottom <= platform.boundary_bottom:
+                        platform.bottom = platform.boundary_bottom
+                        if platform.change_y < 0:
+                            platform.change_y *= -1
+
+                    platform.center_y += platform.change_y
+
+    def update(self):
+        """
+        Move everything and resolve collisions.
+
+        Without merged walls this is arcade's own update.
+
+        :returns: Sprites hit, not counting the merged walls
+        :rtype: list
+        """
+        if self.static_rects is None:
+            return super().update()
+
+        # --- Add gravity if we aren't on a ladder
+        if not self.is_on_ladder():
+            self.player_sprite.change_y -= self.gravity_constant
+
+        hit_list = self.move_player()
+        if self.moving_platforms:
+            self.move_platforms()
+        return hit_list
@@ -0,0 +1,463 @@
+"""scene_layers.py - Coins, animated tiles, moving platforms and chunks of a Scene's layers."""
+
+import collections
+import copy
+import os
+
+import arcade
+import numpy
+import pytiled_parser
+from arcade.resources import resolve_resource_path
+
+from map_cache import HIT_BOXES, tile_texture_args
+from physics import TILE_SIZE, hit_box_bounds
+
+# Static layers are drawn, and streamed, in chunks of CHUNK_TILES by
+# CHUNK_TILES tiles
+CHUNK_TILES = 16
+
+# When streaming, chunks this many chunks around the view are loaded,
+# and chunks further away than STREAM_RELEASE_CHUNKS are released
+STREAM_LOAD_CHUNKS = 1
+STREAM_RELEASE_CHUNKS = 2
+
+
+class CoinGrid:
+    """A class to index coins in a grid so pickups only look near the player."""
+    def __init__(self, coins: arcade.SpriteList, cell_size: float = TILE_SIZE):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.cells_for_coin = {}
+
+        # Points are read from the Tiled properties once, None if missing
+        self.points = {}
+
+        for coin in coins:
+            self.add(coin)
+
+    def add(self, coin: arcade.Sprite):
+        """Put a coin in the grid."""
+        cells = []
+        for cell in self.cells_for_box(*hit_box_bounds(coin)):
+            self.cells.setdefault(cell, []).append(coin)
+            cells.append(cell)
+        self.cells_for_coin[coin] = cells
+        if "Points" in coin.properties:
+            self.points[coin] = int(coin.properties["Points"])
+        else:
+            self.points[coin] = None
+
+    def cells_for_box(self, left: float, right: float, bottom: float, top: float):
+        """Yield every cell a box overlaps."""
+        size = self.cell_size
+        for cell_x in range(int(left // size), int(right // size) + 1):
+            for cell_y in range(int(bottom // size), int(top // size) + 1):
+                yield cell_x, cell_y
+
+    def collisions(self, sprite: arcade.Sprite) -> list:
+        """Return the coins touching a sprite."""
+        nearby = []
+        cells = self.cells
+        for cell in self.cells_for_box(*hit_box_bounds(sprite)):
+            coins = cells.get(cell)
+            if coins:
+                nearby.extend(coins)
+        if not nearby:
+            return nearby
+        return [coin for coin in set(nearby) if arcade.check_for_collision(sprite, coin)]
+
+    def remove(self, coin: arcade.Sprite):
+        """Take a coin out of the grid."""
+        for cell in self.cells_for_coin.pop(coin):
+            self.cells[cell].remove(coin)
+
+
+class TileAnimator:
+    """
+    A class to step the frame timers of many animated tiles at once.
+
+    The timers and frame numbers live in arrays while the animator runs, so
+    a tick is a few array operations plus a texture change for each tile
+    that moved on a frame. The sprites' own time_counter is only written
+    back by sync.
+    """
+    def __init__(self, sprite_lists: list):
+        self.sprites = [
+            sprite for sprite_list in sprite_lists for sprite in sprite_list
+            if isinstance(sprite, arcade.AnimatedTimeBasedSprite) and sprite.frames
+        ]
+        count = len(self.sprites)
+        self.rows = numpy.arange(count)
+
+        # Rows still animated, and the row of each sprite to stop one by
+        self.active = numpy.ones(count, dtype=bool)
+        self.row_of = {sprite: row for row, sprite in enumerate(self.sprites)}
+
+        # Seconds each frame is shown, a row per sprite padded to the longest
+        longest = max((len(sprite.frames) for sprite in self.sprites), default=1)
+        self.durations = numpy.zeros((count, longest))
+        for row, sprite in enumerate(self.sprites):
+            self.durations[row, :len(sprite.frames)] = [
+                frame.duration / 1000 for frame in sprite.frames
+            ]
+        self.frame_counts = numpy.array([len(sprite.frames) for sprite in self.sprites],
+                                        dtype=numpy.intp)
+
+        self.frames = numpy.array([sprite.cur_frame_idx for sprite in self.sprites],
+                                  dtype=numpy.intp)
+        self.times = numpy.array([sprite.time_counter for sprite in self.sprites],
+                                 dtype=float)
+
+    def update(self, delta_time: float):
+        """Advance every timer, as AnimatedTimeBasedSprite.update_animation does."""
+        if not self.sprites:
+            return
+        times, frames, durations = self.times, self.frames, self.durations
+        times += delta_time
+
+        # A long tick can move a tile on by more than one frame
+        changed = numpy.zeros(len(self.sprites), dtype=bool)
+        rows = self.rows[(times > durations[self.rows, frames]) & self.active]
+        while rows.size:
+            times[rows] -= durations[rows, frames[rows]]
+            frames[rows] = (frames[rows] + 1) % self.frame_counts[rows]
+            changed[rows] = True
+            rows = rows[times[rows] > durations[rows, frames[rows]]]
+
+        for row in numpy.flatnonzero(changed).tolist():
+            sprite = self.sprites[row]
+            frame = int(frames[row])
+            sprite.cur_frame_idx = frame
+            sprite.texture = sprite.frames[frame].texture
+
+    def remove(self, sprite: arcade.Sprite):
+        """Stop animating a sprite taken out of the scene."""
+        row = self.row_of.get(sprite)
+        if row is not None:
+            self.active[row] = False
+
+    def sync(self):
+        """Write the timers back to the sprites."""
+        for sprite, frame, time_counter in zip(self.sprites, self.frames.tolist(),
+                                               self.times.tolist()):
+            sprite.cur_frame_idx = frame
+            sprite.time_counter = time_counter
+
+
+class PlatformMover:
+    """
+    A class to move a layer of moving platforms with array math.
+
+    One update does what PhysicsEngine.move_platforms followed by
+    Scene.update does to each platform: turn around at the boundaries, move,
+    then move again without a boundary check. Only the platforms that moved
+    have their position written back.
+    """
+    def __init__(self, platforms: arcade.SpriteList):
+        self.sprite_list = platforms
+        self.platforms = list(platforms)
+        count = len(self.platforms)
+
+        # Sprites in no other list can have their position buffer written directly
+        self.only_in_list = all(sprite.sprite_lists == [platforms] for sprite in self.platforms)
+
+        self.x = numpy.array([sprite.center_x for sprite in self.platforms], dtype=float)
+        self.y = numpy.array([sprite.center_y for sprite in self.platforms], dtype=float)
+        self.change_x = numpy.array([sprite.change_x for sprite in self.platforms], dtype=float)
+        self.change_y = numpy.array([sprite.change_y for sprite in self.platforms], dtype=float)
+
+        # Hit box edges relative to the center, as the platforms never turn or scale
+        edges = numpy.zeros((4, count))
+        for row, sprite in enumerate(self.platforms):
+            hit_box = sprite.get_adjusted_hit_box()
+            if hit_box:
+                edges[:, row] = (
+                    min(x for x, _ in hit_box) - sprite.center_x,
+                    max(x for x, _ in hit_box) - sprite.center_x,
+                    min(y for _, y in hit_box) - sprite.center_y,
+                    max(y for _, y in hit_box) - sprite.center_y,
+                )
+        self.left_edge, self.right_edge, self.bottom_edge, self.top_edge = edges
+
+        # Boundaries, NaN where a platform has none. The engine skips left and
+        # right boundaries of 0 too.
+        def boundaries(name: str, zero_is_none: bool) -> numpy.ndarray:
+            values = []
+            for sprite in self.platforms:
+                value = getattr(sprite, name)
+                values.append(numpy.nan if value is None or (zero_is_none and not value)
+                              else value)
+            return numpy.array(values, dtype=float)
+
+        self.boundary_left = boundaries("boundary_left", True)
+        self.boundary_right = boundaries("boundary_right", True)
+        self.boundary_bottom = boundaries("boundary_bottom", False)
+        self.boundary_top = boundaries("boundary_top", False)
+
+    def update(self):
+        """Move every platform one tick."""
+        if not self.platforms:
+            return
+        x, y = self.x, self.y
+        change_x, change_y = self.change_x, self.change_y
+        moving = (change_x != 0) | (change_y != 0)
+
+        before_x, before_y = change_x.copy(), change_y.copy()
+
+        # NaN boundaries compare False, so platforms without one never stop
+        with numpy.errstate(invalid="ignore"):
+            stop = moving & (x + self.left_edge <= self.boundary_left)
+            x[stop] += self.boundary_left[stop] - (x[stop] + self.left_edge[stop])
+            change_x[stop & (change_x < 0)] *= -1
+
+            stop = moving & (x + self.right_edge >= self.boundary_right)
+            x[stop] += self.boundary_right[stop] - (x[stop] + self.right_edge[stop])
+            change_x[stop & (change_x > 0)] *= -1
+
+            stop = moving & (y + self.top_edge >= self.boundary_top)
+            y[stop] += self.boundary_top[stop] - (y[stop] + self.top_edge[stop])
+            change_y[stop & (change_y > 0)] *= -1
+
+            stop = moving & (y + self.bottom_edge <= self.boundary_bottom)
+            y[stop] += self.boundary_bottom[stop] - (y[stop] + self.bottom_edge[stop])
+            change_y[stop & (change_y < 0)] *= -1
+
+        # Once by the engine and once by the scene
+        x += change_x
+        x += change_x
+        y += change_y
+        y += change_y
+
+        self.write_back(numpy.flatnonzero(moving))
+        platforms = self.platforms
+        turned = (before_x != change_x) | (before_y != change_y)
+        for row in numpy.flatnonzero(turned).tolist():
+            platforms[row].change_x = float(change_x[row])
+            platforms[row].change_y = float(change_y[row])
+
+    def write_back(self, rows: numpy.ndarray):
+        """Give the platforms in rows their new positions."""
+        platforms = self.platforms
+        new_xs, new_ys = self.x[rows].tolist(), self.y[rows].tolist()
+        sprite_list = self.sprite_list
+        if sprite_list.spatial_hash is not None or not self.only_in_list:
+            for row, new_x, new_y in zip(rows.tolist(), new_xs, new_ys):
+                platforms[row].position = new_x, new_y
+            return
+
+        # Nothing but the list's position buffer tracks where the platforms
+        # are, so fill that in one go instead of a sprite at a time
+        # pylint: disable=protected-access
+        slot_of = sprite_list.sprite_slot
+        slots = numpy.array([slot_of[platforms[row]] for row in rows.tolist()],
+                            dtype=numpy.intp)
+        buffer = numpy.frombuffer(sprite_list._sprite_pos_data, dtype=numpy.float32)
+        buffer[slots * 2] = self.x[rows]
+        buffer[slots * 2 + 1] = self.y[rows]
+        sprite_list._sprite_pos_changed = True
+
+        for row, new_x, new_y in zip(rows.tolist(), new_xs, new_ys):
+            platform = platforms[row]
+            platform._position = new_x, new_y
+            platform._point_list_cache = None
+
+
+class SceneChunks:
+    """A class to split a Scene's static layers into chunks and draw those in view."""
+    def __init__(self, scene: arcade.Scene, layer_names: tuple,
+                 chunk_size: float = CHUNK_TILES * TILE_SIZE):
+        self.scene = scene
+        self.chunk_size = chunk_size
+
+        # Chunk SpriteLists of each layer, keyed by chunk (x, y)
+        self.layers = {}
+
+        # Furthest a sprite reaches outside the chunk its center is in
+        self.margin = 0
+
+        # Every chunked sprite with its chunk, to put back removed ones
+        self.members = []
+
+        for name in layer_names:
+            if name not in scene.name_mapping:
+                continue
+            chunks = {}
+            for sprite in scene[name]:
+                chunk = int(sprite.center_x // chunk_size), int(sprite.center_y // chunk_size)
+                if chunk not in chunks:
+                    chunks[chunk] = arcade.SpriteList()
+                chunks[chunk].append(sprite)
+                self.members.append((sprite, chunks[chunk]))
+                self.margin = max(self.margin, sprite.width / 2, sprite.height / 2)
+            self.layers[name] = chunks
+
+        # Scene draw order, with the chunks of each chunked layer
+        names = {id(sprite_list): name for name, sprite_list in scene.name_mapping.items()}
+        self.order = [(sprite_list, self.layers.get(names.get(id(sprite_list))))
+                      for sprite_list in scene.sprite_lists]
+
+    def restore(self):
+        """Put sprites removed since the chunks were built back in their chunks."""
+        for sprite, chunk in self.members:
+            if chunk not in sprite.sprite_lists:
+                chunk.append(sprite)
+
+    def draw(self, left: float, bottom: float, width: float, height: float):
+        """Draw the scene, skipping chunks outside the view."""
+        size, margin = self.chunk_size, self.margin
+        first_x, last_x = int((left - margin) // size), int((left + width + margin) // size)
+        first_y, last_y = int((bottom - margin) // size), int((bottom + height + margin) // size)
+
+        for sprite_list, chunks in self.order:
+            if chunks is None:
+                sprite_list.draw()
+                continue
+            for chunk_x in range(first_x, last_x + 1):
+                for chunk_y in range(first_y, last_y + 1):
+                    chunk = chunks.get((chunk_x, chunk_y))
+                    if chunk:
+                        chunk.draw()
+
+
+class TileStreamer:
+    """A class to create the sprites of a map's tile layers only near the camera."""
+    def __init__(self, map_name: str, scaling: float, layer_options: dict,
+                 layer_names: tuple, chunk_tiles: int = CHUNK_TILES):
+        tiled_map = pytiled_parser.parse_map(resolve_resource_path(map_name))
+
+        # Streamed layers are loaded empty, and their tiles kept here
+        self.layers = {}
+        layers = []
+        for layer in tiled_map.layers:
+            if isinstance(layer, pytiled_parser.TileLayer) and layer.name in layer_names:
+                self.layers[layer.name] = layer
+                layer = copy.copy(layer)
+                layer.data = []
+            layers.append(layer)
+        tiled_map.layers = layers
+
+        self.tile_map = arcade.TileMap(tiled_map=tiled_map, scaling=scaling,
+                                       layer_options=layer_options)
+        self.chunk_tiles = chunk_tiles
+        self.tile_width = self.tile_map.tile_width * scaling
+        self.tile_height = self.tile_map.tile_height * scaling
+
+        # Sprites of each loaded chunk, with their (layer name, column, row)
+        self.loaded = {}
+
+        # Tiles the game has removed, such as collected coins
+        self.gone = set()
+
+        # Tiles whose texture has its hit box from the cache
+        self.prepared = set()
+
+    def build_scene(self) -> arcade.Scene:
+        """Create a Scene holding the map's layers in order, as Scene.from_tilemap does."""
+        scene = arcade.Scene()
+        for name, sprite_list in self.tile_map.sprite_lists.items():
+            # add_sprite_list would swap an empty streamed layer for a new SpriteList
+            scene.sprite_lists.append(sprite_list)
+            scene.name_mapping[name] = sprite_list
+        return scene
+
+    def chunks_near(self, left: float, bottom: float, width: float, height: float,
+                    margin: int) -> list:
+        """Return the chunks within a margin of chunks around a view."""
+        chunk_width = self.chunk_tiles * self.tile_width
+        chunk_height = self.chunk_tiles * self.tile_height
+        last_x = (self.tile_map.width - 1) // self.chunk_tiles
+        last_y = (self.tile_map.height - 1) // self.chunk_tiles
+        return [
+            (chunk_x, chunk_y)
+            for chunk_x in range(max(int(left // chunk_width) - margin, 0),
+                                 min(int((left + width) // chunk_width) + margin, last_x) + 1)
+            for chunk_y in range(max(int(bottom // chunk_height) - margin, 0),
+                                 min(int((bottom + height) // chunk_height) + margin, last_y) + 1)
+        ]
+
+    def update(self, left: float, bottom: float, width: float, height: float) -> tuple:
+        """
+        Load the chunks near a view and release the chunks far from it.
+
+        :returns: (added, removed) lists of sprites by layer name
+        :rtype: tuple
+        """
+        added = collections.defaultdict(list)
+        removed = collections.defaultdict(list)
+
+        keep = set(self.chunks_near(left, bottom, width, height, STREAM_RELEASE_CHUNKS))
+        for chunk in [chunk for chunk in self.loaded if chunk not in keep]:
+            self.release_chunk(chunk, removed)
+
+        for chunk in self.chunks_near(left, bottom, width, height, STREAM_LOAD_CHUNKS):
+            if chunk not in self.loaded:
+                self.load_chunk(chunk, added)
+
+        return added, removed
+
+    def load_chunk(self, chunk: tuple, added: dict):
+        """Create the sprites of a chunk, as arcade.TileMap would have."""
+        tile_map = self.tile_map
+        size = self.chunk_tiles
+        columns = range(chunk[0] * size, min((chunk[0] + 1) * size, tile_map.width))
+        rows = range(chunk[1] * size, min((chunk[1] + 1) * size, tile_map.height))
+        tiles = []
+
+        for name, layer in self.layers.items():
+            sprite_list = tile_map.sprite_lists[name]
+            for row in rows:
+                # Tiled rows count down from the top of the map
+                map_row = layer.data[tile_map.height - row - 1]
+                for column in columns:
+                    tile_gid = map_row[column]
+                    tile_key = (name, column, row)
+                    if tile_gid == 0 or tile_key in self.gone:
+                        continue
+
+                    # pylint: disable=protected-access
+                    tile = tile_map._get_tile_by_gid(tile_gid)
+                    if tile_gid not in self.prepared:
+                        self.prepare_texture(tile)
+                        self.prepared.add(tile_gid)
+                    sprite = tile_map._create_sprite_from_tile(
+                        tile,
+                        scaling=tile_map.scaling,
+                        hit_box_algorithm=tile_map.hit_box_algorithm,
+                        hit_box_detail=tile_map.hit_box_detail,
+                    )
+                    sprite.center_x = column * self.tile_width + sprite.width / 2
+                    sprite.center_y = row * self.tile_height + sprite.height / 2
+                    if layer.tint_color:
+                        sprite.color = layer.tint_color
+                    if layer.opacity:
+                        sprite.alpha = int(layer.opacity * 255)
+
+                    sprite_list.append(sprite)
+                    tiles.append((tile_key, sprite))
+                    added[name].append(sprite)
+
+        self.loaded[chunk] = tiles
+
+    def prepare_texture(self, tile: pytiled_parser.Tile):
+        """Load a tile's texture with its hit box from the cache, before arcade does."""
+        map_directory = os.path.dirname(self.tile_map.tiled_map.map_file)
+        HIT_BOXES.fill(arcade.load_texture(*tile_texture_args(tile, map_directory),
+                                           hit_box_algorithm=self.tile_map.hit_box_algorithm,
+                                           hit_box_detail=self.tile_map.hit_box_detail))
+
+    def release_chunk(self, chunk: tuple, removed: dict):
+        """Take the sprites of a chunk out of the scene."""
+        for tile_key, sprite in self.loaded.pop(chunk):
+            if sprite.sprite_lists:
+                removed[tile_key[0]].append(sprite)
+                sprite.remove_from_sprite_lists()
+            else:
+                # Removed by the game, so it stays removed when reloaded
+                self.gone.add(tile_key)
+
+    def reset(self):
+        """Release every chunk and bring back the tiles the game removed."""
+        removed = collections.defaultdict(list)
+        for chunk in list(self.loaded):
+            self.release_chunk(chunk, removed)
+        self.gone.clear()